@@ -0,0 +1,272 @@
+"""
+Batch downloads on top of download_util.
+
+Takes a JSON manifest of artifacts and downloads them through a bounded
+concurrent queue with per-host connection limits, a global bandwidth cap,
+retries with backoff and one aggregated progress bar.
+
+Manifest format:
+    [
+        {"url": "https://host/file.iso", "path": "/tmp/file.iso", "checksum": "sha256:<digest>"},
+        {"url": "https://host/file.ova", "path": "/tmp/file.ova", "checksum_file": "/tmp/SHA256SUMS"}
+    ]
+
+Pre-requisites:
+- requests library: pip3 install requests
+- tqdm library: pip3 install tqdm
+"""
+
+import argparse
+import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Condition, Lock
+from urllib.parse import urlparse
+
+import requests
+from tqdm import tqdm
+
+from download_util import download_file_from_url_with_progressbar
+
+logger = logging.getLogger(__name__)
+
+MAX_DOWNLOADS = 4
+PER_HOST_CONNECTIONS = 2
+RETRIES = 3
+BACKOFF = 2
+SIZE_SUFFIXES = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+# client errors worth retrying: request timeout and too many requests
+RETRIABLE_CLIENT_ERRORS = (408, 429)
+
+
+def parse_size(value):
+    """
+    Returns number of bytes for values like 500K, 20M or 1G
+
+    :param value: size string, plain numbers are bytes
+    """
+    value = str(value).strip().upper().rstrip('B')
+    if value and value[-1] in SIZE_SUFFIXES:
+        return int(float(value[:-1]) * SIZE_SUFFIXES[value[-1]])
+    return int(float(value))
+
+
+def is_permanent_error(error):
+    """
+    Returns True for HTTP 4xx errors a retry cannot fix, eg. 404
+    """
+    response = getattr(error, 'response', None)
+    return isinstance(error, requests.HTTPError) and response is not None \
+        and 400 <= response.status_code < 500 and response.status_code not in RETRIABLE_CLIENT_ERRORS
+
+
+class BandwidthLimiter:
+    """
+    Thread-safe limiter keeping the combined transfer rate of all downloads at or
+    below bytes_per_sec. A rate of None or 0 disables limiting.
+    """
+
+    def __init__(self, bytes_per_sec=None):
+        self.bytes_per_sec = bytes_per_sec
+        self.next_slot = time.monotonic()
+        self.lock = Lock()
+
+    def consume(self, size):
+        if not self.bytes_per_sec:
+            return
+        with self.lock:
+            now = time.monotonic()
+            wait = self.next_slot - now
+            self.next_slot = max(now, self.next_slot) + size / self.bytes_per_sec
+        if wait > 0:
+            time.sleep(wait)
+
+
+class HostLimiter:
+    """
+    Caps the number of connections open to each host across all downloads.
+    """
+
+    def __init__(self, per_host=PER_HOST_CONNECTIONS):
+        self.per_host = per_host
+        self.in_use = {}
+        self.condition = Condition()
+
+    def acquire(self, host, connections):
+        connections = min(connections, self.per_host)
+        with self.condition:
+            self.condition.wait_for(lambda: self.in_use.get(host, 0) + connections <= self.per_host)
+            self.in_use[host] = self.in_use.get(host, 0) + connections
+        return connections
+
+    def release(self, host, connections):
+        with self.condition:
+            self.in_use[host] -= connections
+            self.condition.notify_all()
+
+
+class AggregateProgress:
+    """
+    One progress bar for all downloads, throttled by the bandwidth limiter.
+    Implements the progress protocol of download_file_from_url_with_progressbar.
+    """
+
+    def __init__(self, bar, limiter):
+        self.bar = bar
+        self.limiter = limiter
+        self.lock = Lock()
+
+    def add_total(self, size, downloaded):
+        with self.lock:
+            self.bar.total = (self.bar.total or 0) + size
+            self.bar.update(downloaded)
+
+    def update(self, size):
+        self.limiter.consume(size)
+        with self.lock:
+            self.bar.update(size)
+
+
+class FileProgress:
+    """
+    Progress of one file in an AggregateProgress. A retried download reports its
+    total again, so only the change since the previous attempt reaches the bar.
+    """
+
+    def __init__(self, aggregate):
+        self.aggregate = aggregate
+        self.size = 0
+        self.counted = 0
+        self.lock = Lock()
+
+    def add_total(self, size, downloaded):
+        with self.lock:
+            size_change, downloaded_change = size - self.size, downloaded - self.counted
+            self.size, self.counted = size, downloaded
+        self.aggregate.add_total(size_change, downloaded_change)
+
+    def update(self, size):
+        with self.lock:
+            self.counted += size
+        self.aggregate.update(size)
+
+
+class DownloadManager:
+    def __init__(self, max_downloads=MAX_DOWNLOADS, per_host=PER_HOST_CONNECTIONS, bandwidth=None,
+                 retries=RETRIES, backoff=BACKOFF, connections=1):
+        """
+        :param max_downloads: number of files downloaded at the same time
+        :param per_host: maximum connections open to one host
+        :param bandwidth: maximum combined bytes per second, None for unlimited
+        :param retries: attempts after the first failure of a file
+        :param backoff: seconds before the first retry, doubled on every further retry
+        :param connections: connections used per file; above 1 files are fetched as Range segments
+        """
+        self.max_downloads = max_downloads
+        self.host_limiter = HostLimiter(per_host)
+        self.bandwidth_limiter = BandwidthLimiter(bandwidth)
+        self.retries = retries
+        self.backoff = backoff
+        self.connections = connections
+
+    @staticmethod
+    def load_manifest(manifest_file):
+        """
+        Returns list of download entries from a JSON manifest
+        """
+        with open(manifest_file) as fin:
+            entries = json.load(fin)
+        for entry in entries:
+            if "url" not in entry or "path" not in entry:
+                raise ValueError(f"Manifest entry needs url and path: {entry}")
+        return entries
+
+    def _download(self, entry, progress):
+        url, path = entry["url"], entry["path"]
+        host = urlparse(url).netloc
+        result = {"url": url, "path": path, "status": "FAILED", "attempts": 0, "bytes": 0, "seconds": 0,
+                  "bytes_per_sec": None, "digest": None, "error": None}
+        file_progress = FileProgress(progress)
+        for attempt in range(self.retries + 1):
+            result["attempts"] = attempt + 1
+            connections = self.host_limiter.acquire(host, self.connections)
+            start = time.monotonic()
+            error = None
+            try:
+                os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+                result["digest"] = download_file_from_url_with_progressbar(
+                    url, path, os.path.basename(path), connections=connections, checksum=entry.get("checksum"),
+                    checksum_file=entry.get("checksum_file"), progress=file_progress)
+            except Exception as ex:
+                error = ex
+            finally:
+                # free the host slot before any backoff so other files to the host can proceed
+                self.host_limiter.release(host, connections)
+                result["seconds"] = round(result["seconds"] + time.monotonic() - start, 3)
+            if error is None:
+                result["status"] = "SUCCEEDED"
+                result["error"] = None
+                result["bytes"] = os.path.getsize(path)
+                result["bytes_per_sec"] = round(result["bytes"] / result["seconds"]) if result["seconds"] else None
+                logger.info(f"Downloaded {url} to {path}")
+                return result
+            result["error"] = str(error)
+            logger.warning(f"Attempt {attempt + 1} to download {url} failed: {error}")
+            if is_permanent_error(error):
+                break
+            if attempt < self.retries:
+                time.sleep(self.backoff * 2 ** attempt)
+        logger.error(f"Failed to download {url} after {result['attempts']} attempts: {result['error']}")
+        return result
+
+    def download_all(self, entries):
+        """
+        Downloads every manifest entry and returns the per-file summary list
+
+        :param entries: list of dicts with url, path and optional checksum or checksum_file
+        """
+        start = time.monotonic()
+        with tqdm(total=0, unit='B', unit_scale=True, miniters=1, desc=f"{len(entries)} files") as bar:
+            progress = AggregateProgress(bar, self.bandwidth_limiter)
+            with ThreadPoolExecutor(max_workers=self.max_downloads, thread_name_prefix='download') as pool:
+                results = list(pool.map(lambda entry: self._download(entry, progress), entries))
+        elapsed = time.monotonic() - start
+        total_bytes = sum(result["bytes"] for result in results)
+        logger.info(f"Downloaded {total_bytes}Bytes in {elapsed:.1f}s, "
+                    f"{sum(result['status'] == 'SUCCEEDED' for result in results)}/{len(results)} files succeeded")
+        return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser("Download manager")
+    parser.add_argument('manifest', help="JSON manifest: list of {url, path, checksum or checksum_file}")
+    parser.add_argument('-n', '--max-downloads', type=int, default=MAX_DOWNLOADS,
+                        help=f"Files downloaded at the same time. Default is {MAX_DOWNLOADS}")
+    parser.add_argument('-H', '--per-host', type=int, default=PER_HOST_CONNECTIONS,
+                        help=f"Maximum connections per host. Default is {PER_HOST_CONNECTIONS}")
+    parser.add_argument('-c', '--connections', type=int, default=1,
+                        help="Connections per file, above 1 uses ranged downloads. Default is 1")
+    parser.add_argument('-b', '--bandwidth', default=None,
+                        help="Maximum combined bandwidth per second, eg. 50M. Default is unlimited")
+    parser.add_argument('-r', '--retries', type=int, default=RETRIES,
+                        help=f"Retries per file with exponential backoff. Default is {RETRIES}")
+    parser.add_argument('-s', '--summary', default=None,
+                        help="Write the per-file JSON summary to this file instead of stdout")
+    args = parser.parse_args()
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(threadName)s - %(levelname)s - %(message)s',
+                        level=logging.WARN)
+
+    manager = DownloadManager(max_downloads=args.max_downloads, per_host=args.per_host,
+                              bandwidth=parse_size(args.bandwidth) if args.bandwidth else None,
+                              retries=args.retries, connections=args.connections)
+    results = manager.download_all(DownloadManager.load_manifest(args.manifest))
+    summary = json.dumps(results, indent=2)
+    if args.summary:
+        with open(args.summary, 'w') as fout:
+            fout.write(summary)
+    else:
+        print(summary)
+    if any(result["status"] != "SUCCEEDED" for result in results):
+        raise SystemExit(1)
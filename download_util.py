@@ -1,23 +1,350 @@
 """
 Pre-requisites:
+- requests library: pip3 install requests
 - tqdm library: pip3 install tqdm
 """
 
+import hashlib
+import json
+import logging
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from threading import Event, Lock
+from urllib.parse import unquote, urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
 from tqdm import tqdm
 
-def download_file_from_url_with_progressbar(url, filepath, filename):
+from hash_util import DIGEST_LENGTHS, HashUtil
+from metrics_util import METRICS, BYTES_PER_SECOND_BUCKETS
+
+logger = logging.getLogger(__name__)
+
+BLOCK_SIZE = 1024 * 1024
+SEGMENT_SIZE = 16 * 1024 * 1024
+STATE_SUFFIX = '.download.json'
+STATE_SAVE_INTERVAL = 1
+# shared so a checksum file is parsed once for all downloads listed in it
+HASH_UTIL = HashUtil()
+
+
+def expected_digest(filepath, checksum=None, checksum_file=None, url=None):
+    """
+    Returns tuple of (algorithm, digest) a download must match, or None if nothing is expected
+
+    :param filepath: destination file path; its base name is looked up in checksum_file
+    :param checksum: hex digest, optionally prefixed with the algorithm as "sha256:<digest>"
+    :param checksum_file: md5sum/sha256sum or BSD style checksum file
+    :param url: optional download URL; its base name is looked up when the destination was renamed
+    """
+    if checksum:
+        algorithm, _, digest = checksum.rpartition(':')
+        digest = digest.lower()
+        algorithm = algorithm.lower() or DIGEST_LENGTHS.get(len(digest))
+        if not algorithm:
+            raise ValueError(f"Cannot tell the algorithm of checksum {checksum}, prefix it like sha256:<digest>")
+        return algorithm, digest
+    if checksum_file:
+        names = [os.path.basename(filepath)]
+        if url:
+            names.append(os.path.basename(unquote(urlparse(url).path)))
+        for name in names:
+            entry = HASH_UTIL.get_check_sum_entry(checksum_file, name) if name else None
+            if entry is not None:
+                return entry
+        raise ValueError(f"No checksum for {' or '.join(dict.fromkeys(filter(None, names)))} in {checksum_file}")
+    return None
+
+
+def _verify_digest(filepath, expected, actual, state=None):
+    if expected and actual != expected[1]:
+        os.remove(filepath)
+        if state:
+            state.remove()
+        raise Exception(f"Checksum mismatch for {filepath}: Expected {expected[0]} {expected[1]} <=> Actual {actual}")
+
+
+def download_file_from_url_with_progressbar(url, filepath, filename, connections=1, checksum=None,
+                                            checksum_file=None, progress=None):
+    """
+    Downloads url to filepath showing a progress bar.
+    With connections > 1 the file is fetched as HTTP Range segments over that many
+    connections and an interrupted download resumes from its sidecar state file.
+    When a checksum or checksum file is given the data is hashed while it is written
+    and a mismatching file is removed.
+    Returns hex digest of the file if a checksum was expected, else None
+
+    :param url: URL to download
+    :param filepath: destination file path
+    :param filename: name shown in the progress bar
+    :param connections: number of concurrent connections. Default is 1, a single stream
+    :param checksum: expected hex digest, optionally prefixed with the algorithm as "sha256:<digest>"
+    :param checksum_file: md5sum/sha256sum or BSD style checksum file listing the file
+    :param progress: optional shared progress object used instead of a per-file progress bar;
+                     it gets add_total(size, already_downloaded) once and update(bytes) per chunk
+    """
+    expected = expected_digest(filepath, checksum, checksum_file, url)
+    if connections > 1:
+        return download_file_in_segments(url, filepath, filename, connections, expected, progress)
+    return _download_file_single_stream(url, filepath, filename, expected, progress)
+
+
+def _record_download(mode, size, start):
+    seconds = time.perf_counter() - start
+    METRICS.observe('download_seconds', seconds, {'mode': mode})
+    if seconds:
+        METRICS.observe('download_bytes_per_second', size / seconds, {'mode': mode}, BYTES_PER_SECOND_BUCKETS)
+
+
+def _download_file_single_stream(url, filepath, filename, expected=None, progress=None):
+    start = time.perf_counter()
     if os.path.exists(filepath):
         os.remove(filepath)
+    hasher = hashlib.new(expected[0]) if expected else None
     with requests.get(url, stream=True) as res:
         res.raise_for_status()
-        block_size = 1024 * 1024
+        block_size = BLOCK_SIZE
         total_size_in_bytes= int(res.headers.get('content-length', 0))
         logger.info(f"File size: {total_size_in_bytes}Bytes")
-        with tqdm.wrapattr(open(filepath, "wb"), "write",
+        if progress:
+            progress.add_total(total_size_in_bytes, 0)
+            fout = open(filepath, "wb")
+        else:
+            # wrapattr gives a context manager yielding the wrapped file
+            fout = tqdm.wrapattr(open(filepath, "wb"), "write",
                    miniters=1, desc=filename,
-                   total=int(res.headers.get('content-length', 0))) as fout:
+                   total=int(res.headers.get('content-length', 0)))
+        with fout as fout:
             for chunk in res.iter_content(chunk_size=block_size):
                 fout.write(chunk)
+                METRICS.inc('download_bytes_total', len(chunk))
+                if hasher:
+                    hasher.update(chunk)
+                if progress:
+                    progress.update(len(chunk))
     if not os.path.exists(filepath) or  os.path.getsize(filepath) != total_size_in_bytes:
         raise Exception("Error while downloading file. ")
+    _record_download('single', total_size_in_bytes, start)
+    if hasher:
+        _verify_digest(filepath, expected, hasher.hexdigest())
+        return hasher.hexdigest()
+    return None
+
+
+class SegmentHasher:
+    """
+    Hashes a segmented download in file order while it is being written: each
+    completed segment is read back, usually from the page cache, as soon as every
+    segment before it is hashed.
+    """
+
+    def __init__(self, filepath, state, algorithm):
+        self.filepath = filepath
+        self.state = state
+        self.hasher = hashlib.new(algorithm)
+        self.starts = sorted(state.done)
+        self.next = 0
+        self.lock = Lock()
+
+    def advance(self, wait=False):
+        if not self.lock.acquire(blocking=wait):
+            # another thread is hashing and will pick up completed segments
+            return
+        try:
+            with open(self.filepath, 'rb') as fin:
+                while self.next < len(self.starts):
+                    start = self.starts[self.next]
+                    end = self.state.segment_end(start)
+                    if start + self.state.done[start] < end:
+                        break
+                    fin.seek(start)
+                    remaining = end - start
+                    while remaining:
+                        chunk = fin.read(min(BLOCK_SIZE, remaining))
+                        if not chunk:
+                            raise Exception(f"Unexpected end of {self.filepath} at {end - remaining}")
+                        self.hasher.update(chunk)
+                        remaining -= len(chunk)
+                    self.next += 1
+        finally:
+            self.lock.release()
+
+    def hexdigest(self):
+        self.advance(wait=True)
+        if self.next != len(self.starts):
+            raise Exception(f"Download of {self.filepath} is incomplete, cannot verify checksum")
+        return self.hasher.hexdigest()
+
+
+class DownloadState:
+    """
+    Sidecar file recording how many bytes of each segment of a ranged download
+    are on disk, so an interrupted download resumes where it stopped.
+    """
+
+    def __init__(self, filepath, url, size, segment_size=SEGMENT_SIZE):
+        self.path = filepath + STATE_SUFFIX
+        self.url = url
+        self.size = size
+        self.segment_size = segment_size
+        # segment start offset -> bytes downloaded
+        self.done = {start: 0 for start in range(0, size, segment_size)}
+        self.lock = Lock()
+        self.saved_at = 0
+
+    @classmethod
+    def load(cls, filepath, url, size):
+        """
+        Returns the saved state for a download of url into filepath, or None if it cannot be resumed
+        """
+        try:
+            with open(filepath + STATE_SUFFIX) as fin:
+                saved = json.load(fin)
+        except (IOError, ValueError):
+            return None
+        if saved.get("url") != url or saved.get("size") != size or not os.path.exists(filepath) \
+                or os.path.getsize(filepath) != size:
+            return None
+        state = cls(filepath, url, size, saved["segment_size"])
+        state.done.update({int(start): done for start, done in saved["done"].items()})
+        return state
+
+    def segment_end(self, start):
+        return min(start + self.segment_size, self.size)
+
+    def pending(self):
+        return [start for start, done in sorted(self.done.items()) if start + done < self.segment_end(start)]
+
+    def downloaded(self):
+        return sum(self.done.values())
+
+    def advance(self, start, length):
+        with self.lock:
+            self.done[start] += length
+            if time.monotonic() - self.saved_at >= STATE_SAVE_INTERVAL:
+                self._save()
+
+    def save(self):
+        with self.lock:
+            self._save()
+
+    def _save(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as fout:
+            json.dump({"url": self.url, "size": self.size, "segment_size": self.segment_size, "done": self.done}, fout)
+        os.replace(tmp_path, self.path)
+        self.saved_at = time.monotonic()
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def _probe(session, url):
+    """
+    Returns tuple of (size, accepts ranges) for url
+    """
+    with session.get(url, stream=True, headers={'Range': 'bytes=0-0'}) as res:
+        res.raise_for_status()
+        if res.status_code == requests.codes.partial_content:
+            # Content-Range: bytes 0-0/12345
+            total = res.headers.get('content-range', '').rpartition('/')[2]
+            return (int(total), True) if total.isdigit() else (0, False)
+        return int(res.headers.get('content-length', 0)), res.headers.get('accept-ranges', '').lower() == 'bytes'
+
+
+def _download_segment(session, url, filepath, state, start, progress, hasher=None, stop=None):
+    offset = start + state.done[start]
+    end = state.segment_end(start)
+    with session.get(url, stream=True, headers={'Range': f'bytes={offset}-{end - 1}'}) as res:
+        res.raise_for_status()
+        if res.status_code != requests.codes.partial_content:
+            raise Exception(f"Server ignored range request for bytes {offset}-{end - 1}, status {res.status_code}")
+        with open(filepath, 'r+b') as fout:
+            fout.seek(offset)
+            for chunk in res.iter_content(chunk_size=BLOCK_SIZE):
+                if stop is not None and stop.is_set():
+                    # the download is being cancelled; what is written so far is in the state file
+                    return
+                chunk = chunk[:end - offset]
+                fout.write(chunk)
+                offset += len(chunk)
+                METRICS.inc('download_bytes_total', len(chunk))
+                state.advance(start, len(chunk))
+                progress.update(len(chunk))
+    if offset != end:
+        raise Exception(f"Segment at {start} ended at {offset}, expected {end}")
+    if hasher:
+        hasher.advance()
+
+
+def download_file_in_segments(url, filepath, filename, connections=4, expected=None, progress=None):
+    """
+    Downloads url to filepath as HTTP Range segments fetched over concurrent connections
+    into a preallocated file, resuming from the sidecar state file if one matches.
+    Falls back to a single stream when the server does not accept ranges.
+
+    :param url: URL to download
+    :param filepath: destination file path
+    :param filename: name shown in the progress bar
+    :param connections: number of concurrent connections. Default is 4
+    :param expected: optional tuple of (algorithm, digest) the file is verified against while downloading
+    :param progress: optional shared progress object, see download_file_from_url_with_progressbar
+    """
+    start = time.perf_counter()
+    session = requests.Session()
+    session.mount('http://', HTTPAdapter(pool_maxsize=connections))
+    session.mount('https://', HTTPAdapter(pool_maxsize=connections))
+    with session:
+        total_size_in_bytes, accepts_ranges = _probe(session, url)
+        if not accepts_ranges or not total_size_in_bytes:
+            logger.info(f"Server does not accept range requests for {url}, downloading as a single stream")
+            return _download_file_single_stream(url, filepath, filename, expected, progress)
+        logger.info(f"File size: {total_size_in_bytes}Bytes")
+
+        state = DownloadState.load(filepath, url, total_size_in_bytes)
+        if state:
+            logger.info(f"Resuming download of {filename} at {state.downloaded()}Bytes")
+        else:
+            if os.path.exists(filepath):
+                os.remove(filepath)
+            with open(filepath, 'wb') as fout:
+                fout.truncate(total_size_in_bytes)
+            state = DownloadState(filepath, url, total_size_in_bytes)
+        state.save()
+        resumed_at = state.downloaded()
+        hasher = SegmentHasher(filepath, state, expected[0]) if expected else None
+
+        if progress:
+            progress.add_total(total_size_in_bytes, state.downloaded())
+            progress_bar = nullcontext(progress)
+        else:
+            progress_bar = tqdm(total=total_size_in_bytes, initial=state.downloaded(), unit='B', unit_scale=True,
+                                miniters=1, desc=filename)
+        with progress_bar as progress:
+            stop = Event()
+            pool = ThreadPoolExecutor(max_workers=connections, thread_name_prefix='download')
+            try:
+                futures = [pool.submit(_download_segment, session, url, filepath, state, start, progress, hasher, stop)
+                           for start in state.pending()]
+                for future in futures:
+                    future.result()
+            except BaseException:
+                # on a failed segment or Ctrl-C drop queued segments and stop running ones after their current chunk
+                stop.set()
+                pool.shutdown(cancel_futures=True)
+                raise
+            finally:
+                pool.shutdown()
+                state.save()
+    if not os.path.exists(filepath) or  os.path.getsize(filepath) != total_size_in_bytes \
+            or state.downloaded() != total_size_in_bytes:
+        raise Exception("Error while downloading file. ")
+    _record_download('segmented', total_size_in_bytes - resumed_at, start)
+    if hasher:
+        _verify_digest(filepath, expected, hasher.hexdigest(), state)
+    state.remove()
+    return hasher.hexdigest() if hasher else None
@@ -1,34 +1,290 @@
+import argparse
 import hashlib
+import json
+import logging
+import os
+import re
+import sqlite3
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from threading import Lock
+
+from metrics_util import METRICS
+
+CHUNK_SIZE = 1024 * 1024
+# hex digest length -> algorithm, for md5sum/sha*sum style lines which do not name it
+DIGEST_LENGTHS = {32: "md5", 40: "sha1", 56: "sha224", 64: "sha256", 96: "sha384", 128: "sha512"}
+# BSD style: "SHA256 (file.iso) = 3a7b..."
+BSD_CHECKSUM_LINE = re.compile(r'^(?P<algorithm>[A-Za-z0-9-]+) ?\((?P<name>.+)\) ?= ?(?P<digest>[0-9a-fA-F]+)$')
+# GNU style: "3a7b...  file.iso" (text mode) or "3a7b... *file.iso" (binary mode)
+GNU_CHECKSUM_LINE = re.compile(r'^\\?(?P<digest>[0-9a-fA-F]+) [ *](?P<name>.+)$')
+DIGEST_CACHE_FILE = os.path.join(os.path.expanduser("~"), ".cache", "python-utils", "digests.sqlite")
+DIGEST_CACHE_MAX_ENTRIES = 100000
+
+
+def _digest_file(fname, algorithms=("md5",)):
+    # module level so it can be pickled into a process pool
+    hashes = [hashlib.new(algorithm) for algorithm in algorithms]
+    buf = bytearray(CHUNK_SIZE)
+    view = memoryview(buf)
+    total = 0
+    with METRICS.timer("hash_seconds", {"algorithms": ",".join(algorithms)}):
+        with open(fname, "rb", buffering=0) as f:
+            for size in iter(lambda: f.readinto(buf), 0):
+                chunk = view[:size]
+                for h in hashes:
+                    h.update(chunk)
+                total += size
+    METRICS.inc("hash_bytes_total", total)
+    METRICS.inc("hash_files_total")
+    return {algorithm: h.hexdigest() for algorithm, h in zip(algorithms, hashes)}
+
+
+def hashlib_name(algorithm):
+    """
+    Returns the hashlib name of a checksum file algorithm name, eg. SHA3-256 -> sha3_256 and SHA-256 -> sha256.
+    Unknown names are returned lower-cased.
+
+    :param algorithm: algorithm name as written in a BSD style checksum line
+    """
+    algorithm = algorithm.lower()
+    for candidate in (algorithm, algorithm.replace("-", "_"), algorithm.replace("-", "")):
+        if candidate in hashlib.algorithms_available:
+            return candidate
+    return algorithm
+
+
+def parse_check_sum_line(line):
+    """
+    Returns tuple of (file name, algorithm, digest) for a md5sum/sha256sum or BSD style
+    checksum line, or None if the line is not a checksum entry
+
+    :param line: one line of a checksum file
+    """
+    line = line.strip()
+    match = GNU_CHECKSUM_LINE.match(line)
+    if match and len(match.group("digest")) in DIGEST_LENGTHS:
+        digest = match.group("digest").lower()
+        return match.group("name"), DIGEST_LENGTHS[len(digest)], digest
+    match = BSD_CHECKSUM_LINE.match(line)
+    if match:
+        return match.group("name"), hashlib_name(match.group("algorithm")), match.group("digest").lower()
+    return None
+
+
+class ChecksumIndex:
+    """
+    Checksum file parsed once into file name -> (algorithm, digest).
+    Names can also be looked up by base name when that base name is listed only once.
+    """
+
+    def __init__(self, checksum_file):
+        self.checksum_file = checksum_file
+        self.entries = {}
+        self.by_basename = {}
+        with open(checksum_file, 'r') as content_file:
+            for line in content_file:
+                entry = parse_check_sum_line(line)
+                if entry:
+                    name = os.path.normpath(entry[0])
+                    self.entries[name] = entry[1:]
+                    basename = os.path.basename(name)
+                    # None marks a base name listed more than once
+                    self.by_basename[basename] = None if basename in self.by_basename else name
+
+    def __len__(self):
+        return len(self.entries)
+
+    def resolve(self, name):
+        """
+        Returns the listed name matching name, or None if not listed
+
+        :param name: file name or relative path as listed in the checksum file
+        """
+        name = os.path.normpath(name)
+        if name in self.entries:
+            return name
+        if os.path.basename(name) == name:
+            return self.by_basename.get(name)
+        return None
+
+    def lookup(self, name):
+        """
+        Returns tuple of (algorithm, digest) for name, or None if not listed
+
+        :param name: file name or relative path as listed in the checksum file
+        """
+        listed = self.resolve(name)
+        return self.entries[listed] if listed else None
+
+
+def _stat_key(fname):
+    st = os.stat(fname)
+    return st.st_size, st.st_mtime_ns, st.st_ino
+
+
+class DigestCache:
+    """
+    SQLite backed cache of file digests keyed by absolute path and algorithm.
+    An entry is only used while the file size, mtime_ns and inode are unchanged;
+    the least recently used entries are evicted beyond max_entries. Reads do not
+    write; last use times of hits are saved in one transaction by flush().
+    """
+
+    def __init__(self, db_file=DIGEST_CACHE_FILE, max_entries=DIGEST_CACHE_MAX_ENTRIES):
+        self.db_file = db_file
+        self.max_entries = max_entries
+        self.lock = Lock()
+        # (last_used, path, algorithm) of cache hits not yet written
+        self.touched = []
+        if db_file != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(db_file)), exist_ok=True)
+        self.conn = sqlite3.connect(db_file, check_same_thread=False)
+        with self.conn:
+            self.conn.execute("CREATE TABLE IF NOT EXISTS digests (path TEXT, algorithm TEXT, size INTEGER, "
+                              "mtime_ns INTEGER, inode INTEGER, digest TEXT, last_used REAL, "
+                              "PRIMARY KEY (path, algorithm))")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS digests_last_used ON digests (last_used)")
+
+    def get(self, fname, algorithm, stat_key):
+        """
+        Returns cached digest of fname, or None if missing or the file changed
+
+        :param fname: file path
+        :param algorithm: hashlib algorithm name
+        :param stat_key: tuple of (size, mtime_ns, inode) of the file now
+        """
+        path = os.path.abspath(fname)
+        with self.lock:
+            row = self.conn.execute("SELECT size, mtime_ns, inode, digest FROM digests WHERE path = ? AND algorithm = ?",
+                                    (path, algorithm)).fetchone()
+            # a stale row is replaced when the new digest is put
+            if row is None or tuple(row[:3]) != tuple(stat_key):
+                return None
+            self.touched.append((time.time(), path, algorithm))
+            return row[3]
+
+    def put(self, fname, digests, stat_key):
+        """
+        Stores digests of fname
+
+        :param fname: file path
+        :param digests: dictionary of algorithm -> hex digest
+        :param stat_key: tuple of (size, mtime_ns, inode) of the file when it was hashed
+        """
+        path = os.path.abspath(fname)
+        now = time.time()
+        with self.lock, self.conn:
+            self._flush()
+            self.conn.executemany("INSERT OR REPLACE INTO digests VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                  [(path, algorithm, *stat_key, digest, now) for algorithm, digest in digests.items()])
+            excess = self.conn.execute("SELECT COUNT(*) FROM digests").fetchone()[0] - self.max_entries
+            if excess > 0:
+                self.conn.execute("DELETE FROM digests WHERE rowid IN "
+                                  "(SELECT rowid FROM digests ORDER BY last_used LIMIT ?)", (excess,))
+
+    def _flush(self):
+        if self.touched:
+            self.conn.executemany("UPDATE digests SET last_used = ? WHERE path = ? AND algorithm = ?", self.touched)
+            self.touched = []
+
+    def flush(self):
+        """
+        Writes the last use times of cache hits in one transaction
+        """
+        with self.lock, self.conn:
+            self._flush()
+
+    def close(self):
+        self.flush()
+        with self.lock:
+            self.conn.close()
+
 
 class HashUtil:
 
-    def __init__(self):
-        pass
+    def __init__(self, cache=None):
+        """
+        :param cache: optional DigestCache; unchanged files are then not hashed again
+        """
+        self.cache = cache
+        self.indexes = {}
+        self.lock = Lock()
 
     def get_md5(self, fname):
-        hash_md5 = hashlib.md5()
-        with open(fname, "rb") as f:
-            for chunk in iter(lambda: f.read(4096), b""):
-                hash_md5.update(chunk)
-        return hash_md5.hexdigest()
+        return self.get_digests(fname, ("md5",))["md5"]
+
+    def get_digests(self, fname, algorithms=("md5", "sha1", "sha256")):
+        """
+        Returns dictionary of algorithm -> hex digest, reading the file only once
+        and only for the algorithms missing from the cache
+
+        :param fname: file to hash
+        :param algorithms: any hashlib algorithm names
+        """
+        if self.cache is None:
+            return _digest_file(fname, tuple(algorithms))
+        digests, stat_key = self._lookup(fname, algorithms)
+        missing = tuple(algorithm for algorithm in algorithms if algorithm not in digests)
+        if missing:
+            digests.update(self._store(fname, _digest_file(fname, missing), stat_key))
+        return digests
+
+    def _lookup(self, fname, algorithms):
+        stat_key = _stat_key(fname)
+        digests = {}
+        for algorithm in algorithms:
+            digest = self.cache.get(fname, algorithm, stat_key)
+            if digest:
+                digests[algorithm] = digest
+        METRICS.inc("hash_cache_hits_total", len(digests))
+        return digests, stat_key
+
+    def _store(self, fname, digests, stat_key):
+        # skip files modified while they were hashed
+        if _stat_key(fname) == stat_key:
+            self.cache.put(fname, digests, stat_key)
+        return digests
 
+    def get_check_sum_entry(self, checksum_file, name):
+        """
+        Returns tuple of (algorithm, digest) for name in checksum_file, or None if not listed
+
+        :param checksum_file: md5sum/sha256sum or BSD style checksum file
+        :param name: file name as listed in the checksum file
+        """
+        return self.get_check_sum_index(checksum_file).lookup(name)
+
+    def get_check_sum_index(self, checksum_file):
+        """
+        Returns ChecksumIndex of checksum_file, parsed once and reused until the file changes
+
+        :param checksum_file: md5sum/sha256sum or BSD style checksum file
+        """
+        path = os.path.abspath(checksum_file)
+        stat_key = _stat_key(path)
+        with self.lock:
+            cached = self.indexes.get(path)
+            if cached and cached[0] == stat_key:
+                return cached[1]
+            index = ChecksumIndex(path)
+            self.indexes[path] = (stat_key, index)
+            logging.debug("Indexed {0} entries of {1}".format(len(index), checksum_file))
+            return index
 
     def get_check_sum(self, checksum_file, content):
-        checksum = None
-        with open(checksumFile, 'r') as content_file:
-            checksum = content_file.read()
-        for line in checksum.split("\n"):
-            if content in line:
-                return line.split(" ")[0].strip()
-        return None
+        # content used to be matched as "*name"; the binary mode marker is not part of the name
+        entry = self.get_check_sum_entry(checksum_file, content[1:] if content.startswith("*") else content)
+        return entry[1] if entry else None
 
     def  validate_check_sum(self, file, name, checksum_file):
         logging.info(
             "Check Checksum for {0} with {1}".format(
-                file, checksumFile))
-        checksum = self.get_check_sum(checksum_file, "*{0}".format(name))
-        logging.info("Calculating Checksum for {0}".format(file))
-        targetChecksum = self.get_md5(file)
+                file, checksum_file))
+        entry = self.get_check_sum_entry(checksum_file, name)
+        algorithm, checksum = entry if entry else ("md5", None)
+        logging.info("Calculating {0} Checksum for {1}".format(algorithm, file))
+        targetChecksum = self.get_digests(file, (algorithm,))[algorithm]
         logging.info("Got Checksum as {0}".format(targetChecksum))
 
         if checksum == targetChecksum:
@@ -40,3 +296,145 @@ class HashUtil:
                 "Checksum didnt not match: Expected: {0} <=> Actual: {1}".
                     format(checksum, targetChecksum))
             return False
+
+    @staticmethod
+    def list_files(paths, exclude=()):
+        """
+        Returns sorted list of regular files in paths; directories are expanded recursively
+
+        :param paths: list of file and directory paths
+        :param exclude: file paths to leave out, eg. the checksum file itself
+        """
+        excluded = {os.path.abspath(path) for path in exclude}
+        files = []
+        for path in paths:
+            if os.path.isdir(path):
+                for root, _, names in os.walk(path):
+                    files.extend(os.path.join(root, name) for name in names)
+            else:
+                files.append(path)
+        return sorted(f for f in files if os.path.isfile(f) and os.path.abspath(f) not in excluded)
+
+    def _submit_digest(self, pool, fname, algorithm):
+        """
+        Returns a callable giving the digest of fname, from the cache or hashed on pool
+        """
+        stat_key = None
+        if self.cache is not None:
+            try:
+                digests, stat_key = self._lookup(fname, (algorithm,))
+            except OSError as ex:
+                def raise_error(error=ex):
+                    raise error
+                return raise_error
+            if digests:
+                return lambda: digests[algorithm]
+        future = pool.submit(_digest_file, fname, (algorithm,))
+        if self.cache is None:
+            return lambda: future.result()[algorithm]
+        return lambda: self._store(fname, future.result(), stat_key)[algorithm]
+
+    def validate_check_sums(self, paths, checksum_file, max_workers=None, use_processes=False):
+        """
+        Validates many files against checksum_file, hashing them in parallel. Files not listed
+        in checksum_file are not hashed, and listed files missing next to it are reported too.
+        Returns list of per-file reports: dicts with file, status, algorithm, expected, actual, matched
+        and error keys; status is one of OK, FAILED, UNLISTED or MISSING
+
+        :param paths: list of files and/or directories to validate
+        :param checksum_file: md5sum/sha256sum or BSD style checksum file
+        :param max_workers: pool size. Default is the number of CPUs
+        :param use_processes: hash in a process pool instead of a thread pool
+        """
+        files = self.list_files(paths, exclude=[checksum_file])
+        max_workers = max_workers or os.cpu_count() or 1
+        logging.info("Validating {0} files against {1} with {2} {3}".format(
+            len(files), checksum_file, max_workers, "processes" if use_processes else "threads"))
+        reports = []
+        pool_class = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+        with pool_class(max_workers=max_workers) as pool:
+            futures = {}
+            index = self.get_check_sum_index(checksum_file)
+            checksum_dir = os.path.dirname(os.path.abspath(checksum_file))
+            found = set()
+            for f in files:
+                relpath = os.path.normpath(os.path.relpath(os.path.abspath(f), checksum_dir))
+                if relpath.split(os.sep)[0] != os.pardir:
+                    listed = relpath if relpath in index.entries else None
+                else:
+                    # files outside the checksum file's directory are matched by base name, unless the
+                    # listed entry exists next to the checksum file, in which case f is another file
+                    listed = index.resolve(os.path.basename(f))
+                    if listed is not None and os.path.exists(os.path.join(checksum_dir, listed)):
+                        listed = None
+                if listed is None:
+                    futures[f] = (None, None, None)
+                    continue
+                found.add(listed)
+                algorithm, expected = index.entries[listed]
+                if algorithm not in hashlib.algorithms_available:
+                    futures[f] = (algorithm, expected, None)
+                    continue
+                futures[f] = (algorithm, expected, self._submit_digest(pool, f, algorithm))
+            for f, (algorithm, expected, future) in futures.items():
+                report = {"file": f, "status": "FAILED", "algorithm": algorithm, "expected": expected,
+                          "actual": None, "matched": False, "error": None}
+                if future is None:
+                    if expected is None:
+                        report["status"] = "UNLISTED"
+                        report["error"] = "No checksum found in {0}".format(checksum_file)
+                        logging.warning("Skipped {0}: {1}".format(f, report["error"]))
+                    else:
+                        report["error"] = "Unsupported checksum algorithm {0}".format(algorithm)
+                        logging.error("Cannot validate {0}: {1}".format(f, report["error"]))
+                    reports.append(report)
+                    continue
+                try:
+                    report["actual"] = future()
+                except (IOError, OSError, ValueError) as ex:
+                    report["error"] = str(ex)
+                report["matched"] = report["error"] is None and report["actual"] == expected
+                if report["matched"]:
+                    report["status"] = "OK"
+                    logging.info("Checksum matched for {0}: {1}".format(f, expected))
+                else:
+                    logging.error("Checksum didnt not match for {0}: Expected: {1} <=> Actual: {2}{3}".format(
+                        f, expected, report["actual"], "; " + report["error"] if report["error"] else ""))
+                reports.append(report)
+        if self.cache is not None:
+            self.cache.flush()
+        # like md5sum -c, listed files that do not exist next to the checksum file fail
+        for listed, (algorithm, expected) in index.entries.items():
+            path = os.path.join(checksum_dir, listed)
+            if listed not in found and not os.path.isfile(path):
+                logging.error("Listed file {0} is missing".format(path))
+                reports.append({"file": path, "status": "MISSING", "algorithm": algorithm, "expected": expected,
+                                "actual": None, "matched": False, "error": "No such file"})
+        return reports
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser("Hash util")
+    parser.add_argument('checksum_file', help="md5sum/sha256sum or BSD style checksum file")
+    parser.add_argument('paths', nargs='+', help="Files and/or directories to validate")
+    parser.add_argument('-w', '--workers', type=int, default=None,
+                        help="Number of files hashed in parallel. Default is the number of CPUs")
+    parser.add_argument('-p', '--processes', action='store_true', default=False,
+                        help="Hash in a process pool instead of a thread pool")
+    parser.add_argument('--cache', default=DIGEST_CACHE_FILE,
+                        help="Digest cache database; unchanged files are not hashed again. "
+                             "Default is {0}".format(DIGEST_CACHE_FILE))
+    parser.add_argument('--no-cache', action='store_true', default=False, help="Always hash every file")
+    parser.add_argument('--json', action='store_true', default=False, help="Print the report as JSON")
+    args = parser.parse_args()
+    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s', level=logging.INFO)
+
+    cache = None if args.no_cache else DigestCache(args.cache)
+    reports = HashUtil(cache).validate_check_sums(args.paths, args.checksum_file, args.workers, args.processes)
+    if args.json:
+        print(json.dumps(reports, indent=2))
+    else:
+        for report in reports:
+            print("{0}: {1}".format(report["status"], report["file"]))
+    if any(report["status"] in ("FAILED", "MISSING") for report in reports):
+        raise SystemExit(1)
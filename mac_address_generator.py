@@ -1,4 +1,19 @@
+import argparse
+import json
+import os
 import random
+import sys
+from array import array
+
+MAC_PREFIX = "50:52"
+ADDRESS_SPACE = 1 << 32
+HEX_DIGITS = b"0123456789abcdef"
+HIGH_NIBBLE = bytes(HEX_DIGITS[value >> 4] for value in range(256))
+LOW_NIBBLE = bytes(HEX_DIGITS[value & 15] for value in range(256))
+# murmur3 fmix32 constants and their inverses modulo 2**32
+FMIX_MULTIPLIERS = (0x85ebca6b, 0xc2b2ae35)
+FMIX_INVERSES = tuple(pow(multiplier, -1, ADDRESS_SPACE) for multiplier in FMIX_MULTIPLIERS)
+
 
 def get_random_mac():
     """
@@ -10,3 +25,210 @@ def get_random_mac():
         random.randint(0, 255),
         random.randint(0, 255),
     )
+
+
+class _Lanes:
+    """
+      Batch of 32 bit values held in 64 bit little-endian lanes of one big integer, so
+      xor, shift, multiply and compare run over the whole batch in a few C level operations.
+      A lane never carries into the next one as values stay below 2**32 and multipliers too.
+    """
+
+    def __init__(self, value, count):
+        self.value = value
+        self.count = count
+        self.ones = int.from_bytes(b"\x01\x00\x00\x00\x00\x00\x00\x00" * count, 'little')
+        self.low_mask = self.ones * 0xffffffff
+
+    @classmethod
+    def from_range(cls, start, count):
+        values = array('Q', range(start, start + count))
+        if sys.byteorder == 'big':
+            values.byteswap()
+        return cls(int.from_bytes(values.tobytes(), 'little'), count)
+
+    def to_bytes(self):
+        return self.value.to_bytes(8 * self.count, 'little')
+
+    def xor(self, key):
+        self.value ^= key * self.ones
+
+    def xorshift(self, shift):
+        self.value ^= (self.value >> shift) & self.low_mask
+
+    def multiply(self, multiplier):
+        self.value = (self.value * multiplier) & self.low_mask
+
+    def fmix(self):
+        self.xorshift(16)
+        self.multiply(FMIX_MULTIPLIERS[0])
+        self.xorshift(13)
+        self.multiply(FMIX_MULTIPLIERS[1])
+        self.xorshift(16)
+
+    def unfmix(self):
+        self.xorshift(16)
+        self.multiply(FMIX_INVERSES[1])
+        self.xorshift(13)
+        self.xorshift(26)
+        self.multiply(FMIX_INVERSES[0])
+        self.xorshift(16)
+
+    def below(self, limit):
+        """
+          Returns bytes with 1 for each lane holding a value below limit, else 0
+        """
+        if limit <= 0:
+            return bytes(self.count)
+        # bit 32 of a lane is set once value + 2**32 - limit reaches 2**32
+        flags = ((self.value + (ADDRESS_SPACE - limit) * self.ones) >> 32) & self.ones
+        return flags.to_bytes(8 * self.count, 'little')[0::8].translate(bytes([1, 0]) + bytes(254))
+
+
+def _drop_flagged(lane_bytes, flags):
+    """
+      Returns lane bytes without the lanes flagged 1
+    """
+    if 1 not in flags:
+        return lane_bytes
+    kept = []
+    start = 0
+    index = flags.find(1)
+    while index != -1:
+        kept.append(lane_bytes[8 * start:8 * index])
+        start = index + 1
+        index = flags.find(1, start)
+    kept.append(lane_bytes[8 * start:])
+    return b"".join(kept)
+
+
+def _format_lanes(lane_bytes):
+    """
+      Get MAC address strings for 32 bit suffixes in 64 bit little-endian lanes, formatted in bulk
+    """
+    count = len(lane_bytes) // 8
+    if not count:
+        return []
+    text = bytearray((MAC_PREFIX + ":00:00:00:00\n").encode() * count)
+    high = lane_bytes.translate(HIGH_NIBBLE)
+    low = lane_bytes.translate(LOW_NIBBLE)
+    for index in range(4):
+        # suffix byte index is lane byte 3 - index; "50:52:" is 6 characters and each byte adds "xx:"
+        text[6 + 3 * index::18] = high[3 - index::8]
+        text[7 + 3 * index::18] = low[3 - index::8]
+    return text[:-1].decode('ascii').split('\n')
+
+
+def format_macs(suffixes):
+    """
+      Get MAC address strings for 32 bit suffixes under the 50:52 prefix
+    """
+    lanes = array('Q', suffixes)
+    if sys.byteorder == 'big':
+        lanes.byteswap()
+    return _format_lanes(lanes.tobytes())
+
+
+class MacAllocator:
+    """
+      Hands out MAC addresses under the 50:52 prefix that were never issued before.
+      Random addresses are a keyed 32 bit permutation of a counter, so they are unique
+      by construction; sequential addresses count up from a cursor and skip any value
+      the permutation already gave out. The issued set is thereby fully described by
+      the key, the counter and the cursor, which are persisted to the state file.
+    """
+
+    def __init__(self, state_file=None):
+        self.state_file = state_file
+        self.keys = tuple(int.from_bytes(os.urandom(4), 'little') for _ in range(2))
+        self.counter = 0
+        self.next_sequential = 0
+        self.issued = 0
+        if state_file and os.path.exists(state_file):
+            self._load()
+
+    def _load(self):
+        with open(self.state_file) as fin:
+            state = json.load(fin)
+        self.keys = tuple(state["keys"])
+        self.counter = state["counter"]
+        self.next_sequential = state["next_sequential"]
+        self.issued = state["issued"]
+
+    def save(self):
+        if not self.state_file:
+            return
+        tmp_file = "%s.%s.tmp" % (self.state_file, os.getpid())
+        with open(tmp_file, 'w') as fout:
+            json.dump({"keys": list(self.keys), "counter": self.counter, "next_sequential": self.next_sequential,
+                       "issued": self.issued}, fout)
+        os.replace(tmp_file, self.state_file)
+
+    def _permute(self, lanes):
+        lanes.xor(self.keys[0])
+        lanes.fmix()
+        lanes.xor(self.keys[1])
+        lanes.fmix()
+
+    def _unpermute(self, lanes):
+        lanes.unfmix()
+        lanes.xor(self.keys[1])
+        lanes.unfmix()
+        lanes.xor(self.keys[0])
+
+    def _random_lanes(self, count):
+        chunks = []
+        while count:
+            batch = min(count, ADDRESS_SPACE - self.counter)
+            if not batch:
+                raise ValueError("MAC addresses under the 50:52 prefix are exhausted")
+            lanes = _Lanes.from_range(self.counter, batch)
+            self._permute(lanes)
+            self.counter += batch
+            # values below the cursor were handed out sequentially
+            chunk = _drop_flagged(lanes.to_bytes(), lanes.below(self.next_sequential))
+            chunks.append(chunk)
+            count -= len(chunk) // 8
+        return b"".join(chunks)
+
+    def _sequential_lanes(self, count):
+        chunks = []
+        while count:
+            batch = min(count, ADDRESS_SPACE - self.next_sequential)
+            if not batch:
+                raise ValueError("MAC addresses under the 50:52 prefix are exhausted")
+            lanes = _Lanes.from_range(self.next_sequential, batch)
+            lane_bytes = lanes.to_bytes()
+            self.next_sequential += batch
+            # values whose counter is below the random counter were handed out randomly
+            self._unpermute(lanes)
+            chunk = _drop_flagged(lane_bytes, lanes.below(self.counter))
+            chunks.append(chunk)
+            count -= len(chunk) // 8
+        return b"".join(chunks)
+
+    def allocate(self, count=1, sequential=False):
+        """
+          Get count MAC addresses never issued by this allocator
+
+          :param count: number of addresses
+          :param sequential: hand out consecutive free addresses, continuing after the last sequential allocation
+        """
+        if self.issued + count > ADDRESS_SPACE:
+            raise ValueError("Only %s MAC addresses left under the 50:52 prefix" % (ADDRESS_SPACE - self.issued))
+        lane_bytes = self._sequential_lanes(count) if sequential else self._random_lanes(count)
+        self.issued += count
+        self.save()
+        return _format_lanes(lane_bytes)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser("MAC address generator")
+    parser.add_argument('-n', '--count', type=int, default=1, help="Number of MAC addresses. Default is 1")
+    parser.add_argument('-s', '--sequential', action='store_true', default=False,
+                        help="Hand out consecutive free addresses for dense packing")
+    parser.add_argument('-f', '--state-file', default=None,
+                        help="File recording issued addresses so they stay unique across runs")
+    args = parser.parse_args()
+
+    print("\n".join(MacAllocator(args.state_file).allocate(args.count, args.sequential)))
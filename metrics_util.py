@@ -0,0 +1,264 @@
+"""
+Lightweight in-process metrics shared by the utilities: counters, histograms and timers.
+
+Metrics are off unless enabled through the PYUTILS_METRICS environment variable or
+METRICS.enable(); while off every call returns after a single attribute check.
+When enabled from the environment a snapshot is written at exit, to stderr or to
+PYUTILS_METRICS_FILE, as JSON or Prometheus text:
+
+    PYUTILS_METRICS=json python3 hash_util.py ...
+    PYUTILS_METRICS=prometheus PYUTILS_METRICS_FILE=/tmp/metrics.prom python3 download_manager.py ...
+
+Metrics recorded in worker processes, eg. hash_util --processes, are not part of the snapshot.
+"""
+
+import atexit
+import bisect
+import json
+import os
+import sys
+import time
+from threading import Lock
+
+METRICS_ENV = 'PYUTILS_METRICS'
+METRICS_FILE_ENV = 'PYUTILS_METRICS_FILE'
+JSON_FORMAT = 'json'
+PROMETHEUS_FORMAT = 'prometheus'
+DISABLED_VALUES = ('', '0', 'off', 'false', 'no')
+SECONDS_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+COUNT_BUCKETS = (1, 2, 3, 5, 10, 20, 50, 100)
+# 1KiB/s to 1GiB/s in steps of 4
+BYTES_PER_SECOND_BUCKETS = tuple(1024 * 4 ** power for power in range(11))
+
+
+def _series(name, labels):
+    if not labels:
+        return name
+    return '%s{%s}' % (name, ','.join('%s="%s"' % (key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                                      for key, value in labels))
+
+
+class Histogram:
+    """
+    Count, sum, min, max and cumulative bucket counts of observed values
+    """
+
+    def __init__(self, buckets=SECONDS_BUCKETS):
+        self.buckets = tuple(buckets)
+        # last slot counts values above the largest bucket
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def cumulative(self):
+        """
+        Returns list of (upper bound, count of values at or below it), ending with +Inf
+        """
+        total = 0
+        bounds = []
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            total += count
+            bounds.append((bound, total))
+        return bounds
+
+    def to_dict(self):
+        return {"count": self.count, "sum": self.sum, "min": self.min, "max": self.max,
+                "mean": self.sum / self.count if self.count else None,
+                "buckets": {str(bound): count for bound, count in self.cumulative()}}
+
+
+class Timer:
+    """
+    Context manager observing its wall time in seconds into a histogram
+    """
+    __slots__ = ('metrics', 'name', 'labels', 'buckets', 'start', 'seconds')
+
+    def __init__(self, metrics, name, labels=None, buckets=SECONDS_BUCKETS):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+        self.buckets = buckets
+        self.start = None
+        self.seconds = 0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.seconds = time.perf_counter() - self.start
+        self.metrics.observe(self.name, self.seconds, self.labels, self.buckets)
+        return False
+
+
+class _NoopTimer:
+    """
+    Timer handed out while metrics are off; seconds stays 0
+    """
+    seconds = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+NOOP_TIMER = _NoopTimer()
+
+
+class Metrics:
+    """
+    Thread-safe registry of counters and histograms keyed by name and optional labels
+    """
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.counters = {}
+        self.histograms = {}
+        self.lock = Lock()
+        self.dump_registered = False
+
+    @staticmethod
+    def _key(name, labels):
+        return (name, tuple(sorted(labels.items()))) if labels else (name, ())
+
+    def enable(self, dump_format=None, dump_file=None):
+        """
+        Starts recording; with a dump_format the snapshot is written at exit
+
+        :param dump_format: JSON_FORMAT or PROMETHEUS_FORMAT, None to not dump at exit
+        :param dump_file: file the snapshot is written to. Default is stderr
+        """
+        self.enabled = True
+        if dump_format and not self.dump_registered:
+            atexit.register(self.dump, dump_format, dump_file)
+            self.dump_registered = True
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+    def inc(self, name, value=1, labels=None):
+        """
+        Adds value to a counter
+
+        :param name: counter name, by convention ending in _total
+        :param value: amount added. Default is 1
+        :param labels: optional dictionary of label name -> value
+        """
+        if not self.enabled:
+            return
+        key = self._key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, labels=None, buckets=SECONDS_BUCKETS):
+        """
+        Records value in a histogram
+
+        :param name: histogram name
+        :param value: observed value
+        :param labels: optional dictionary of label name -> value
+        :param buckets: bucket upper bounds, used when the histogram is created
+        """
+        if not self.enabled:
+            return
+        key = self._key(name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    def timer(self, name, labels=None, buckets=SECONDS_BUCKETS):
+        """
+        Returns context manager observing the seconds spent in it into histogram name
+
+        :param name: histogram name, by convention ending in _seconds
+        :param labels: optional dictionary of label name -> value
+        :param buckets: bucket upper bounds, used when the histogram is created
+        """
+        if not self.enabled:
+            return NOOP_TIMER
+        return Timer(self, name, labels, buckets)
+
+    def snapshot(self):
+        """
+        Returns dictionary of counters and histograms keyed by Prometheus style series name
+        """
+        with self.lock:
+            return {"counters": {_series(*key): value for key, value in sorted(self.counters.items())},
+                    "histograms": {_series(*key): histogram.to_dict()
+                                   for key, histogram in sorted(self.histograms.items())}}
+
+    def to_prometheus(self):
+        """
+        Returns the metrics in Prometheus text exposition format
+        """
+        lines = []
+        typed = set()
+        with self.lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                if name not in typed:
+                    lines.append('# TYPE %s counter' % name)
+                    typed.add(name)
+                lines.append('%s %s' % (_series(name, labels), value))
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                if name not in typed:
+                    lines.append('# TYPE %s histogram' % name)
+                    typed.add(name)
+                for bound, count in histogram.cumulative():
+                    lines.append('%s %s' % (_series(name + '_bucket', labels + (('le', bound),)), count))
+                lines.append('%s %s' % (_series(name + '_sum', labels), histogram.sum))
+                lines.append('%s %s' % (_series(name + '_count', labels), histogram.count))
+        return '\n'.join(lines) + '\n' if lines else ''
+
+    def dump(self, dump_format=JSON_FORMAT, dump_file=None):
+        """
+        Writes a snapshot as JSON or Prometheus text
+
+        :param dump_format: JSON_FORMAT or PROMETHEUS_FORMAT
+        :param dump_file: file the snapshot is written to. Default is stderr
+        """
+        if dump_format == PROMETHEUS_FORMAT:
+            text = self.to_prometheus()
+        else:
+            text = json.dumps(self.snapshot(), indent=2) + '\n'
+        if dump_file:
+            with open(dump_file, 'w') as fout:
+                fout.write(text)
+        else:
+            sys.stderr.write(text)
+
+
+METRICS = Metrics()
+
+
+def configure_from_env():
+    """
+    Enables METRICS when PYUTILS_METRICS is set; its value picks the snapshot format, json or prometheus
+    """
+    value = os.environ.get(METRICS_ENV, '').strip().lower()
+    if value in DISABLED_VALUES:
+        return
+    METRICS.enable(PROMETHEUS_FORMAT if value == PROMETHEUS_FORMAT else JSON_FORMAT,
+                   os.environ.get(METRICS_FILE_ENV) or None)
+
+
+configure_from_env()
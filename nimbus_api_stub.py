@@ -0,0 +1,210 @@
+"""
+Local stand-in for the Nimbus launcher API used by nimbus_lease_extend.py.
+
+Implements the ctl and status endpoints with configurable task latency, failure
+rates and inventory size so NimbusLeaseExtend can be exercised and benchmarked
+without reaching nimbus-api.eng.vmware.com.
+
+    python3 nimbus_api_stub.py --port 8080 --vms 5000 --testbeds 500
+    python3 nimbus_lease_extend.py -u user -l sc --api-base-url http://127.0.0.1:8080/api
+"""
+
+import argparse
+import json
+import logging
+import random
+import re
+import time
+import uuid
+from collections import Counter
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread, Lock
+
+
+API_PREFIX = '/api'
+CTL_PATH = re.compile(r'^/v1/launcher/nimbus/ctl$')
+STATUS_PATH = re.compile(r'^/v1/launcher/nimbus/([^/]+)/status$')
+STATS_PATH = '/stats'
+PODS = 10
+TASK_LATENCY = (0.5, 2.0)
+LIST_LATENCY = (2.0, 5.0)
+LEASE_SPREAD_DAYS = 7
+
+
+class NimbusApiStub:
+    """
+    In-memory Nimbus API. Every ctl call creates a task that finishes after a random
+    latency, failing with probability `failure_rate`. Each request additionally
+    answers HTTP 503 with probability `error_rate`.
+    """
+    def __init__(self, host='127.0.0.1', port=0, vms=1000, testbeds=100, task_latency=TASK_LATENCY,
+                 list_latency=LIST_LATENCY, failure_rate=0.0, error_rate=0.0, seed=None):
+        self.task_latency = task_latency
+        self.list_latency = list_latency
+        self.failure_rate = failure_rate
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.tasks = {}
+        self.requests = Counter()
+        self.lock = Lock()
+        self.vm_pods, self.testbed_pods = self._build_inventory(vms, testbeds)
+        self.server = ThreadingHTTPServer((host, port), self._handler())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}{API_PREFIX}'
+
+    def _lease_expiry(self):
+        expiry = time.time() + self.random.uniform(0, LEASE_SPREAD_DAYS * 24 * 60 * 60)
+        return datetime.fromtimestamp(expiry, timezone.utc).isoformat()
+
+    def _build_inventory(self, vms, testbeds):
+        vm_pods = {f'pod-{pod}': {} for pod in range(PODS)}
+        for index in range(vms):
+            vm_pods[f'pod-{index % PODS}'][f'vm-{index}'] = {"leaseExpiresAt": self._lease_expiry()}
+        testbed_pods = {f'pod-{pod}': {} for pod in range(PODS)}
+        for index in range(testbeds):
+            testbed_pods[f'pod-{index % PODS}'][str(index)] = {"name": f'testbed-{index}',
+                                                                "leaseExpiresAt": self._lease_expiry()}
+        return vm_pods, testbed_pods
+
+    def create_task(self, payload):
+        args = payload.get("args", [])
+        if args[-1:] == ["list"]:
+            latency = self.random.uniform(*self.list_latency)
+            result = self.testbed_pods if "--testbed" in args else self.vm_pods
+            failed = False
+        else:
+            latency = self.random.uniform(*self.task_latency)
+            result = {}
+            failed = self.random.random() < self.failure_rate
+        task_id = uuid.uuid4().hex
+        with self.lock:
+            self.tasks[task_id] = {"done_at": time.monotonic() + latency, "failed": failed, "result": result}
+        return {"id": task_id}
+
+    def task_status(self, task_id):
+        with self.lock:
+            task = self.tasks.get(task_id)
+        if task is None:
+            return None
+        if time.monotonic() < task["done_at"]:
+            return {"id": task_id, "status": "RUNNING"}
+        if task["failed"]:
+            return {"id": task_id, "status": "FAILED"}
+        return {"id": task_id, "status": "SUCCEEDED", "result": task["result"]}
+
+    def stats(self):
+        with self.lock:
+            return dict(self.requests)
+
+    def _count(self, key):
+        with self.lock:
+            self.requests[key] += 1
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                logging.debug(format % args)
+
+            def _send(self, code, body):
+                data = json.dumps(body).encode()
+                self.send_response(code)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _path(self):
+                path = self.path.split('?')[0]
+                return path[len(API_PREFIX):] if path.startswith(API_PREFIX) else path
+
+            def _injected_error(self):
+                if stub.error_rate and stub.random.random() < stub.error_rate:
+                    stub._count('injected_errors')
+                    self._send(503, {"error": "injected failure"})
+                    return True
+                return False
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                if not CTL_PATH.match(self._path()):
+                    self._send(404, {"error": "not found"})
+                    return
+                stub._count('ctl')
+                if self._injected_error():
+                    return
+                try:
+                    payload = json.loads(body)
+                except ValueError:
+                    self._send(400, {"error": "invalid JSON"})
+                    return
+                self._send(200, stub.create_task(payload))
+
+            def do_GET(self):
+                path = self._path()
+                if path == STATS_PATH:
+                    self._send(200, stub.stats())
+                    return
+                match = STATUS_PATH.match(path)
+                if not match:
+                    self._send(404, {"error": "not found"})
+                    return
+                stub._count('status')
+                if self._injected_error():
+                    return
+                status = stub.task_status(match.group(1))
+                if status is None:
+                    self._send(404, {"error": f"unknown task {match.group(1)}"})
+                else:
+                    self._send(200, status)
+
+        return Handler
+
+    def start(self):
+        self.thread = Thread(name="nimbus_api_stub", target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        logging.info(f'Nimbus API stub listening on {self.base_url}')
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        if self.thread:
+            self.thread.join()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser("Nimbus API stub")
+    parser.add_argument('--host', default='127.0.0.1', help='Address to listen on. Default is 127.0.0.1')
+    parser.add_argument('-p', '--port', type=int, default=8080, help='Port to listen on. Default is 8080')
+    parser.add_argument('--vms', type=int, default=1000, help='Number of VMs in the inventory. Default is 1000')
+    parser.add_argument('--testbeds', type=int, default=100,
+                        help='Number of testbeds in the inventory. Default is 100')
+    parser.add_argument('--task-latency', type=float, nargs=2, default=TASK_LATENCY, metavar=('MIN', 'MAX'),
+                        help=f'Seconds an extend task runs. Default is {TASK_LATENCY}')
+    parser.add_argument('--list-latency', type=float, nargs=2, default=LIST_LATENCY, metavar=('MIN', 'MAX'),
+                        help=f'Seconds a list task runs. Default is {LIST_LATENCY}')
+    parser.add_argument('--failure-rate', type=float, default=0.0,
+                        help='Fraction of extend tasks that end FAILED. Default is 0')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='Fraction of requests answered with HTTP 503. Default is 0')
+    args = parser.parse_args()
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(threadName)s - %(levelname)s - %(message)s', level=logging.INFO)
+
+    stub = NimbusApiStub(args.host, args.port, vms=args.vms, testbeds=args.testbeds,
+                         task_latency=tuple(args.task_latency), list_latency=tuple(args.list_latency),
+                         failure_rate=args.failure_rate, error_rate=args.error_rate)
+    logging.info(f'Nimbus API stub listening on {stub.base_url}')
+    try:
+        stub.server.serve_forever()
+    except KeyboardInterrupt:
+        stub.server.server_close()
@@ -0,0 +1,111 @@
+"""
+End-to-end throughput benchmark for NimbusLeaseExtend against the local Nimbus API stub.
+
+Reports resources/sec, p50/p99 per-resource latency and API request counts for
+each engine, so concurrency and polling changes can be compared.
+
+    python3 nimbus_benchmark.py --vms 2000 --testbeds 200 --max-workers 32 --engines threads async
+"""
+
+import argparse
+import json
+import logging
+import os
+import tempfile
+import time
+
+from nimbus_api_stub import NimbusApiStub
+from nimbus_lease_extend import NimbusLeaseExtend, PollPolicy, THREAD_ENGINE, ASYNC_ENGINE, TESTBED, VM
+
+
+def percentile(values, pct):
+    """
+    Returns the nearest-rank percentile of values, or None when values is empty
+
+    :param values: list of numbers
+    :param pct: percentile between 0 and 100
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[index]
+
+
+def run_benchmark(stub, engine, args):
+    """
+    Returns dictionary of results of one lease extend run of all stub resources
+    """
+    journal_path = os.path.join(tempfile.mkdtemp(prefix='nimbus-bench-'), 'journal.jsonl')
+    extender = NimbusLeaseExtend(max_workers=args.max_workers, rate_limit=args.rate_limit, engine=engine,
+                                 poll_policy=PollPolicy(initial=args.poll_initial, max_interval=args.poll_max_interval,
+                                                        deadline=args.poll_deadline),
+                                 inventory_ttl=0, journal_path=journal_path, api_base_url=stub.base_url)
+    params = argparse.Namespace(user='benchmark', location='sc', testbed_location=None, vm_location=None,
+                                testbed_name=None, vm_name=None, dry_run=False, refresh=True)
+    requests_before = stub.stats()
+    start = time.monotonic()
+    extender._lease_workflow(params, TESTBED, extender.get_testbed_leases)
+    extender._lease_workflow(params, VM, extender.get_vm_leases)
+    elapsed = time.monotonic() - start
+    extender.journal.close()
+    extender.session.close()
+
+    with open(journal_path) as fin:
+        records = [json.loads(line) for line in fin]
+    latencies = [record["latency"] for record in records]
+    requests_after = stub.stats()
+    return {
+        "engine": engine,
+        "resources": len(records),
+        "succeeded": sum(1 for record in records if record["status"] == "SUCCEEDED"),
+        "failed": sum(1 for record in records if record["status"] != "SUCCEEDED"),
+        "seconds": round(elapsed, 3),
+        "resources_per_sec": round(len(records) / elapsed, 2) if elapsed else None,
+        "p50_latency": percentile(latencies, 50),
+        "p99_latency": percentile(latencies, 99),
+        "requests": {key: requests_after.get(key, 0) - requests_before.get(key, 0) for key in requests_after},
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser("Nimbus lease extend benchmark")
+    parser.add_argument('--vms', type=int, default=1000, help='Number of VMs in the stub inventory. Default is 1000')
+    parser.add_argument('--testbeds', type=int, default=100,
+                        help='Number of testbeds in the stub inventory. Default is 100')
+    parser.add_argument('--task-latency', type=float, nargs=2, default=(0.2, 1.0), metavar=('MIN', 'MAX'),
+                        help='Seconds a stub extend task runs. Default is 0.2 1.0')
+    parser.add_argument('--failure-rate', type=float, default=0.0,
+                        help='Fraction of stub extend tasks that end FAILED. Default is 0')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='Fraction of stub requests answered with HTTP 503. Default is 0')
+    parser.add_argument('--engines', nargs='+', choices=[THREAD_ENGINE, ASYNC_ENGINE],
+                        default=[THREAD_ENGINE, ASYNC_ENGINE], help='Engines to benchmark. Default is both')
+    parser.add_argument('-w', '--max-workers', type=int, default=32, help='Worker count. Default is 32')
+    parser.add_argument('-r', '--rate-limit', type=float, default=0,
+                        help='Maximum API calls per second, 0 to disable. Default is 0')
+    parser.add_argument('--poll-initial', type=float, default=0.2, help='Seconds before the first poll. Default is 0.2')
+    parser.add_argument('--poll-max-interval', type=float, default=2,
+                        help='Maximum seconds between polls. Default is 2')
+    parser.add_argument('--poll-deadline', type=float, default=60,
+                        help='Seconds before a running task is reported failed. Default is 60')
+    parser.add_argument('--json', action='store_true', help='Print results as JSON')
+    args = parser.parse_args()
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(threadName)s - %(levelname)s - %(message)s',
+                        level=logging.WARN)
+
+    stub = NimbusApiStub(vms=args.vms, testbeds=args.testbeds, task_latency=tuple(args.task_latency),
+                         list_latency=tuple(args.task_latency), failure_rate=args.failure_rate,
+                         error_rate=args.error_rate).start()
+    try:
+        results = [run_benchmark(stub, engine, args) for engine in args.engines]
+    finally:
+        stub.stop()
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        for result in results:
+            print(f"{result['engine']:>8}: {result['resources']} resources ({result['failed']} failed) in "
+                  f"{result['seconds']}s, {result['resources_per_sec']} resources/sec, "
+                  f"p50 {result['p50_latency']}s, p99 {result['p99_latency']}s, requests {result['requests']}")
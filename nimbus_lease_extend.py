@@ -1,37 +1,300 @@
 import argparse
+import asyncio
+import heapq
 import os.path
 import logging
+import random
+import time
 
 import requests
 import json
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from datetime import datetime
 from pprint import pformat
-from retry import retry
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from threading import Thread, Lock
 
+from metrics_util import METRICS, COUNT_BUCKETS
+
 
 NIMBUS_API_BASE_URL = 'http://nimbus-api.eng.vmware.com/api'
 EXECUTE_NIMBUS_COMMAND = '/v1/launcher/nimbus/ctl'
 GET_COMMAND_EXECUTION_STATUS = '/v1/launcher/nimbus/{0}/status'
 OUT_DIR = 'out'
+CACHE_DIR = 'cache'
 SUCCESS_FILE = 'success.txt'
 FAILURE_FILE = 'failure.txt'
+JOURNAL_FILE = 'journal.jsonl'
 DELAY = 20
 TIMEOUT = 120
-RETRY_COUNT = TIMEOUT // DELAY
+POLL_INITIAL = 2
+POLL_FACTOR = 2
+POLL_JITTER = 0.1
+MAX_WORKERS = 8
+RATE_LIMIT = 5
+CONNECT_TIMEOUT = 10
+READ_TIMEOUT = 60
+HTTP_RETRIES = 3
+HTTP_BACKOFF_FACTOR = 1
+HTTP_RETRY_STATUSES = (500, 502, 503, 504)
+INVENTORY_TTL = 6 * 60 * 60
+LEASE_DAYS = 7
+# keys checked, in order, for the lease expiry of a resource in Nimbus list results
+LEASE_EXPIRY_KEYS = ('leaseExpiresAt', 'lease_expires_at', 'leaseExpiry', 'lease_expiry', 'expiresAt', 'expires_at',
+                     'expiry', 'expires')
+DAEMON_MIN_SLEEP = 5 * 60
+DAEMON_MAX_SLEEP = 24 * 60 * 60
+THREAD_ENGINE = 'threads'
+ASYNC_ENGINE = 'async'
+TESTBED = 'testbed'
+VM = 'VM'
+
+
+class RateLimiter:
+    """
+    Thread-safe limiter spacing calls so that at most `rate` calls start per second.
+    A rate of None or 0 disables limiting.
+    """
+    def __init__(self, rate=None):
+        self.interval = 1.0 / rate if rate else 0
+        self.next_slot = time.monotonic()
+        self.lock = Lock()
+
+    def acquire(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            wait = self.next_slot - now
+            self.next_slot = max(now, self.next_slot) + self.interval
+        if wait > 0:
+            METRICS.observe('nimbus_rate_limit_wait_seconds', wait)
+            time.sleep(wait)
+
+
+class PollPolicy:
+    """
+    Task polling schedule: the first poll waits `initial` seconds, each following
+    wait grows by `factor` up to `max_interval`, randomised by +/- `jitter` (a fraction),
+    and polling gives up once `deadline` seconds have passed since the task started.
+    """
+    def __init__(self, initial=POLL_INITIAL, factor=POLL_FACTOR, max_interval=DELAY, jitter=POLL_JITTER,
+                 deadline=TIMEOUT):
+        self.initial = initial
+        self.factor = factor
+        self.max_interval = max_interval
+        self.jitter = jitter
+        self.deadline = deadline
+
+    def interval(self, attempt):
+        """
+        Returns seconds to wait before poll number attempt + 1
+
+        :param attempt: number of polls done so far, starting at 0
+        """
+        base = min(self.max_interval, self.initial * self.factor ** attempt)
+        return max(0, base * random.uniform(1 - self.jitter, 1 + self.jitter))
+
+
+class NimbusSession:
+    """
+    Thread-safe, lazily created requests.Session shared by the Nimbus API calls of one extender.
+    Keeps connections alive in a pool sized for the workers, applies connect/read
+    timeouts to every request and retries with backoff on connection errors and 5xx.
+    """
+    def __init__(self, pool_size=MAX_WORKERS, connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT,
+                 retries=HTTP_RETRIES, backoff_factor=HTTP_BACKOFF_FACTOR):
+        self.lock = Lock()
+        self._session = None
+        self.pool_size = max(1, pool_size)
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+
+    def _create_session(self):
+        # allowed_methods=None retries POST as well; extending a lease twice is harmless.
+        retry = Retry(total=self.retries, backoff_factor=self.backoff_factor,
+                      status_forcelist=HTTP_RETRY_STATUSES, allowed_methods=None, raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size, max_retries=retry)
+        session = requests.Session()
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    @property
+    def session(self):
+        with self.lock:
+            if self._session is None:
+                self._session = self._create_session()
+            return self._session
+
+    def get(self, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return self.session.get(url, **kwargs)
+
+    def post(self, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return self.session.post(url, **kwargs)
+
+    def close(self):
+        with self.lock:
+            if self._session:
+                self._session.close()
+                self._session = None
+
+
+class InventoryCache:
+    """
+    On-disk cache of testbed/VM leases listed from Nimbus (name -> expiry epoch or None),
+    one JSON file per resource kind, user and location. Entries older than `ttl` seconds
+    are ignored; a ttl of 0 disables the cache.
+    """
+    def __init__(self, ttl=INVENTORY_TTL, cache_dir=None):
+        self.ttl = ttl
+        self.cache_dir = cache_dir or os.path.join(os.path.abspath(os.path.dirname(__file__)), OUT_DIR, CACHE_DIR)
+
+    def _path(self, kind, user, location):
+        return os.path.join(self.cache_dir, f"inventory-{kind.lower()}-{user}-{location}.json")
+
+    def load(self, kind, user, location):
+        """
+        Returns cached dict of name -> lease expiry, or None when there is no fresh cache entry
+        """
+        if not self.ttl:
+            return None
+        file_path = self._path(kind, user, location)
+        try:
+            with open(file_path) as fin:
+                entry = json.load(fin)
+        except (IOError, ValueError):
+            return None
+        age = time.time() - entry.get("created", 0)
+        if age > self.ttl:
+            logging.debug(f"Inventory cache {file_path} expired {age - self.ttl:.0f} seconds ago")
+            return None
+        logging.debug(f"Using inventory cache {file_path} created {age:.0f} seconds ago")
+        return entry.get("leases")
+
+    def store(self, kind, user, location, leases):
+        if not self.ttl:
+            return
+        file_path = self._path(kind, user, location)
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp_path = f"{file_path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, 'w') as fout:
+                json.dump({"created": time.time(), "leases": leases}, fout)
+            os.replace(tmp_path, file_path)
+        except IOError as ex:
+            logging.error(f"Failed to write inventory cache: {file_path};\nError: {ex}")
+
+    def update(self, kind, user, location, leases):
+        """
+        Updates lease expiry of the given names in a fresh cache entry, keeping its creation time
+        """
+        cached = self.load(kind, user, location)
+        if cached is None:
+            return
+        cached.update(leases)
+        file_path = self._path(kind, user, location)
+        try:
+            with open(file_path) as fin:
+                created = json.load(fin)["created"]
+            tmp_path = f"{file_path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'w') as fout:
+                json.dump({"created": created, "leases": cached}, fout)
+            os.replace(tmp_path, file_path)
+        except (IOError, ValueError, KeyError) as ex:
+            logging.error(f"Failed to update inventory cache: {file_path};\nError: {ex}")
+
+
+class ResultJournal:
+    """
+    Append-only JSONL journal with one record per resource, flushed and synced to
+    disk as each resource completes so a killed run loses nothing.
+    """
+    def __init__(self, file_path=None):
+        self.file_path = file_path or os.path.join(os.path.abspath(os.path.dirname(__file__)), OUT_DIR, JOURNAL_FILE)
+        self.lock = Lock()
+        self._fout = None
+
+    def record(self, kind, name, task_id, status, latency, error=None):
+        METRICS.observe('nimbus_lease_seconds', latency, {'kind': kind, 'status': status})
+        entry = {"timestamp": time.time(), "kind": kind, "name": name, "task_id": task_id, "status": status,
+                 "latency": round(latency, 3)}
+        if error:
+            entry["error"] = error
+        line = json.dumps(entry) + "\n"
+        with self.lock:
+            try:
+                if self._fout is None:
+                    os.makedirs(os.path.dirname(self.file_path), exist_ok=True)
+                    self._fout = open(self.file_path, 'a')
+                self._fout.write(line)
+                self._fout.flush()
+                os.fsync(self._fout.fileno())
+            except IOError as ex:
+                logging.error(f"Failed to write to journal: {self.file_path};\nError: {ex}")
+
+    def succeeded_since(self, since):
+        """
+        Returns set of (kind, name) extended successfully at or after epoch seconds since
+
+        :param since: epoch seconds
+        """
+        done = set()
+        try:
+            with open(self.file_path) as fin:
+                for line in fin:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # last line of a killed run may be partial
+                        continue
+                    if entry.get("status") == "SUCCEEDED" and entry.get("timestamp", 0) >= since:
+                        done.add((entry["kind"], entry["name"]))
+        except FileNotFoundError:
+            pass
+        return done
+
+    def close(self):
+        with self.lock:
+            if self._fout:
+                self._fout.close()
+                self._fout = None
 
 
 class NimbusLeaseExtend:
-    def __init__(self):
+    def __init__(self, max_workers=MAX_WORKERS, rate_limit=RATE_LIMIT, connect_timeout=CONNECT_TIMEOUT,
+                 read_timeout=READ_TIMEOUT, retries=HTTP_RETRIES, engine=THREAD_ENGINE, poll_policy=None,
+                 inventory_ttl=INVENTORY_TTL, extend_threshold=0, journal_path=None, resume_window=0,
+                 api_base_url=None):
         self.success_messages = []
         self.failure_messages = []
         self.lock = Lock()
+        self.max_workers = max(1, max_workers)
+        self.rate_limiter = RateLimiter(rate_limit)
+        self.engine = engine
+        self.poll_policy = poll_policy or PollPolicy()
+        self.poll_stats = {}
+        self.inventory_cache = InventoryCache(inventory_ttl)
+        self.extend_threshold = extend_threshold
+        self.next_due = {}
+        self.journal = ResultJournal(journal_path)
+        self.resume_window = resume_window
+        self.already_extended = set()
+        self.api_base_url = (api_base_url or os.environ.get('NIMBUS_API_BASE_URL') or NIMBUS_API_BASE_URL).rstrip('/')
+        # testbed and VM workflows run their worker pools side by side
+        self.session = NimbusSession(pool_size=2 * self.max_workers, connect_timeout=connect_timeout,
+                                     read_timeout=read_timeout, retries=retries)
 
-    @staticmethod
-    def execute_nimbus_command(payload):
+    def execute_nimbus_command(self, payload):
         try:
-            api_url = NIMBUS_API_BASE_URL + EXECUTE_NIMBUS_COMMAND
+            api_url = self.api_base_url + EXECUTE_NIMBUS_COMMAND
             logging.debug(f'Method: POST API: {api_url} Payload: {payload}')
-            r = requests.post(api_url, data=json.dumps(payload))
+            with METRICS.timer('nimbus_api_seconds', {'call': 'execute'}):
+                r = self.session.post(api_url, data=json.dumps(payload))
             if r.status_code == requests.codes.ok:
                 return r.json()
             else:
@@ -39,22 +302,25 @@ class NimbusLeaseExtend:
                 logging.error(message)
                 raise IOError(message)
         except Exception as ex:
+            METRICS.inc('nimbus_api_errors_total', labels={'call': 'execute'})
             message = f"Failed to execute command.\nError: {ex}"
             logging.error(message)
             raise IOError(message)
 
-    @staticmethod
-    def get_command_execution_status(task_id):
+    def get_command_execution_status(self, task_id):
         try:
-            api_url = NIMBUS_API_BASE_URL + GET_COMMAND_EXECUTION_STATUS.format(task_id)
+            api_url = self.api_base_url + GET_COMMAND_EXECUTION_STATUS.format(task_id)
             logging.debug(f'Method: GET API: {api_url}')
-            r = requests.get(api_url)
+            with METRICS.timer('nimbus_api_seconds', {'call': 'status'}):
+                r = self.session.get(api_url)
             if r.status_code == requests.codes.ok:
                 return r.json()
             else:
+                METRICS.inc('nimbus_api_errors_total', labels={'call': 'status'})
                 logging.error(f'Get command status failed. \n Status code: {r.status_code} \n Response: {r.text}')
         except Exception as e:
-            logging.error("Failed to execute command." + e)
+            METRICS.inc('nimbus_api_errors_total', labels={'call': 'status'})
+            logging.error(f"Failed to execute command.\nError: {e}")
     
     @staticmethod
     def dump_to_file(file_path, contents, append=False):
@@ -114,10 +380,11 @@ class NimbusLeaseExtend:
             "user": params.user,
             "args": ["--testbed", "extend_lease", testbed_name],
             "opts": {
-                "lease": 7,
+                "lease": LEASE_DAYS,
                 "nimbusLocation": params.location
             }
         }
+        self.rate_limiter.acquire()
         return self.execute_nimbus_command(payload=payload)['id']
 
     def _extend_vm_lease(self, params, vm_name):
@@ -125,110 +392,300 @@ class NimbusLeaseExtend:
             "user": params.user,
             "args": ["extend_lease", vm_name],
             "opts": {
-                "lease": 7,
+                "lease": LEASE_DAYS,
                 "nimbusLocation": params.location
             }
         }
+        self.rate_limiter.acquire()
         return self.execute_nimbus_command(payload=payload)['id']
 
-    @retry(ValueError, delay=DELAY, tries=RETRY_COUNT)
-    def _poll_task(self, task_id):
+    def _get_task_status(self, task_id):
+        self.rate_limiter.acquire()
         res = self.get_command_execution_status(task_id)
-        status = res['status'].upper()
-        if status == "SUCCEEDED":
-            logging.debug(f'Task status is {status}')
-            return res
-        if status == "FAILED":
-            logging.debug(f'Task status is {status}')
-            return None
-        else:
-            raise ValueError(f'Current task status is {status}, polling task status in {DELAY} seconds')
+        if not res:
+            raise IOError(f'Failed to get status of task {task_id}')
+        return res['status'].upper(), res
+
+    def _record_poll_stats(self, task_id, polls, seconds):
+        logging.debug(f'Task {task_id} finished polling after {polls} polls in {seconds:.1f} seconds')
+        METRICS.observe('nimbus_task_polls', polls, buckets=COUNT_BUCKETS)
+        METRICS.observe('nimbus_task_seconds', seconds)
+        with self.lock:
+            self.poll_stats[task_id] = {"polls": polls, "seconds": seconds}
+
+    def _poll_task(self, task_id):
+        start = time.monotonic()
+        deadline = start + self.poll_policy.deadline
+        polls = 0
+        try:
+            # a task never finishes right after submit, so wait before the first poll too
+            time.sleep(min(self.poll_policy.interval(0), self.poll_policy.deadline))
+            while True:
+                status, res = self._get_task_status(task_id)
+                polls += 1
+                if status == "SUCCEEDED":
+                    logging.debug(f'Task status is {status}')
+                    return res
+                if status == "FAILED":
+                    logging.debug(f'Task status is {status}')
+                    return None
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError(f'Task {task_id} status is still {status} after '
+                                       f'{self.poll_policy.deadline} seconds')
+                delay = min(self.poll_policy.interval(polls), remaining)
+                logging.debug(f'Current task status is {status}, polling task status in {delay:.1f} seconds')
+                time.sleep(delay)
+        finally:
+            self._record_poll_stats(task_id, polls, time.monotonic() - start)
     
-    def get_testbed_names(self, params):
+    @staticmethod
+    def parse_lease_expiry(resource):
+        """
+        Returns lease expiry of a resource from Nimbus list results as epoch seconds, or None if unknown
+
+        :param resource: dictionary describing a testbed or VM
+        """
+        if not isinstance(resource, dict):
+            return None
+        for key in LEASE_EXPIRY_KEYS:
+            value = resource.get(key)
+            if value is None:
+                continue
+            try:
+                if isinstance(value, (int, float)):
+                    # milliseconds since epoch
+                    return value / 1000 if value > 1e11 else float(value)
+                return datetime.fromisoformat(str(value).replace('Z', '+00:00')).timestamp()
+            except (ValueError, OverflowError):
+                logging.debug(f'Unable to parse lease expiry {key}={value}')
+        return None
+
+    def get_testbed_leases(self, params):
+        """
+        Returns dictionary of testbed name -> lease expiry epoch seconds (None if unknown)
+
+        :param params: command-line args from main
+        """
         if params.testbed_name:
-            return [params.testbed_name]
+            return {params.testbed_name: None}
         else:
             logging.info('Getting available testbeds')
             task_id = self._get_testbeds(params)
             response = self._poll_task(task_id)
-            testbeds = []
+            testbeds = {}
             if response:
                 pods_map = response['result']
                 logging.debug(pformat(pods_map))
                 for _, v in pods_map.items():
                     for testbed in v.values():
-                        testbeds.append(testbed["name"])
+                        testbeds[testbed["name"]] = NimbusLeaseExtend.parse_lease_expiry(testbed)
+                self.inventory_cache.store(TESTBED, params.user, NimbusLeaseExtend.get_location(params), testbeds)
             return testbeds
 
-    def get_vm_names(self, params):
+    def get_vm_leases(self, params):
+        """
+        Returns dictionary of VM name -> lease expiry epoch seconds (None if unknown)
+
+        :param params: command-line args from main
+        """
         if params.vm_name:
-            return [params.vm_name]
+            return {params.vm_name: None}
         else:
             logging.info('Getting available VMs')
             task_id = self._get_vms(params)
             response = self._poll_task(task_id)
-            vms = []
+            vms = {}
             if response:
                 pods_map = response['result']
                 logging.debug(pformat(pods_map))
                 for _, v in pods_map.items():
-                    for vm_name in v.keys():
-                        vms.append(vm_name)
+                    for vm_name, vm in v.items():
+                        vms[vm_name] = NimbusLeaseExtend.parse_lease_expiry(vm)
+                self.inventory_cache.store(VM, params.user, NimbusLeaseExtend.get_location(params, False), vms)
             return vms
 
-    def testbed_workflow(self, params):
+    def get_testbed_names(self, params):
+        return list(self.get_testbed_leases(params))
+
+    def get_vm_names(self, params):
+        return list(self.get_vm_leases(params))
+
+    def schedule_leases(self, leases, now=None):
+        """
+        Returns tuple of (names due for extension ordered soonest expiry first,
+        epoch seconds at which the next not yet due lease becomes due or None).
+        Leases with unknown expiry are always due. A threshold of 0 makes every lease due.
+
+        :param leases: dictionary of name -> lease expiry epoch seconds or None
+        :param now: current epoch seconds, defaults to time.time()
+        """
+        now = time.time() if now is None else now
+        queue = [(float('-inf') if expiry is None else expiry, name) for name, expiry in leases.items()]
+        heapq.heapify(queue)
+        due = []
+        while queue and (not self.extend_threshold or queue[0][0] - now <= self.extend_threshold):
+            due.append(heapq.heappop(queue)[1])
+        next_due = queue[0][0] - self.extend_threshold if queue else None
+        return due, next_due
+
+    def _submit_extend(self, params, kind, name):
+        logging.info(f'Extending lease of {kind} [{name}] ...')
+        if kind == TESTBED:
+            return self._extend_testbed_lease(params, name)
+        return self._extend_vm_lease(params, name)
+
+    def _extend_lease(self, params, kind, name):
+        start = time.monotonic()
+        task_id = None
         try:
-            testbed_names = self.get_testbed_names(params)
-            for index, testbed in enumerate(testbed_names):
-                logging.info(f'Extending lease of testbed [{testbed}] ...')
-                if not params.dry_run:
-                    task_id = self._extend_testbed_lease(args, testbed)
-                    response = self._poll_task(task_id)
-                    if response:
-                        logging.info(f'Successfully extended lease for testbed [{testbed}]')
-            if len(testbed_names) > 0:
-                success_message = f"Successfully extended lease for testbeds: {testbed_names}"
-            else:
-                success_message = "No testbeds found for extending lease."
-            # NimbusLeaseExtend.dump_success(success_message)
-            logging.info(success_message)
-            with self.lock:
-                self.success_messages.append(success_message)
-            logging.info('*************** Finished Testbed Workflow *************')
+            task_id = self._submit_extend(params, kind, name)
+            response = self._poll_task(task_id)
         except Exception as ex:
-            failure_message = f"Failed to extend lease for testbeds: {testbed_names[index:]}\n{ex}"
-            logging.error(failure_message)
+            self.journal.record(kind, name, task_id, "FAILED", time.monotonic() - start, str(ex))
+            raise
+        if response:
+            self.journal.record(kind, name, task_id, "SUCCEEDED", time.monotonic() - start)
+        else:
+            self.journal.record(kind, name, task_id, "FAILED", time.monotonic() - start, 'Task status is FAILED')
+        return response
+
+    def extend_leases(self, params, kind, names):
+        """
+        Extends lease of every resource in names using the worker pool.
+        Returns tuple of (succeeded names, dict of failed name -> reason)
+
+        :param params: command-line args from main
+        :param kind: resource kind, either TESTBED or VM
+        :param names: names of resources to extend lease of
+        """
+        if params.dry_run:
+            for name in names:
+                logging.info(f'Extending lease of {kind} [{name}] ... (dry run)')
+            return list(names), {}
+        if self.engine == ASYNC_ENGINE:
+            return asyncio.run(NimbusBatchEngine(self).run(params, kind, names))
+        succeeded, failed = [], {}
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix=f'{kind}_worker') as pool:
+            futures = {pool.submit(self._extend_lease, params, kind, name): name for name in names}
+            for future in as_completed(futures):
+                name = futures[future]
+                try:
+                    response = future.result()
+                except Exception as ex:
+                    logging.error(f'Failed to extend lease for {kind} [{name}]: {ex}')
+                    failed[name] = str(ex)
+                    continue
+                if response:
+                    logging.info(f'Successfully extended lease for {kind} [{name}]')
+                    succeeded.append(name)
+                else:
+                    logging.error(f'Failed to extend lease for {kind} [{name}]: task status is FAILED')
+                    failed[name] = 'Task status is FAILED'
+        return succeeded, failed
+
+    def _extend_due(self, params, kind, leases):
+        names, next_due = self.schedule_leases(leases)
+        if next_due is not None:
             with self.lock:
-                self.failure_messages.append(failure_message)
-            # NimbusLeaseExtend.dump_failure(
-            #     f"Failed to extend testbed lease for testbeds: {testbed_names[index:]}\n{ex}")
+                self.next_due[kind] = min(next_due, self.next_due.get(kind, next_due))
+        skipped = len(leases) - len(names)
+        if skipped:
+            logging.info(f'Skipping {skipped} {kind}s with more than {self.extend_threshold} seconds of lease left')
+        if self.already_extended:
+            resumed = [name for name in names if (kind, name) in self.already_extended]
+            if resumed:
+                logging.info(f'Skipping {len(resumed)} {kind}s already extended in the last '
+                             f'{self.resume_window} seconds: {resumed}')
+                names = [name for name in names if (kind, name) not in self.already_extended]
+        return self.extend_leases(params, kind, names)
 
-    def vm_workflow(self, params):
+    def _extend_cached(self, params, kind, cached_leases, get_leases):
+        """
+        Extends due leases from the cache while the inventory is listed again in the
+        background, then extends newly listed due resources and drops failures for
+        resources that no longer exist.
+        Returns tuple of (all names, succeeded names, dict of failed name -> reason)
+        """
+        logging.info(f'Extending lease of {len(cached_leases)} cached {kind}s while refreshing inventory')
+        refreshed = {}
+
+        def refresh():
+            try:
+                refreshed["leases"] = get_leases(params)
+            except Exception as ex:
+                refreshed["error"] = ex
+
+        refresh_thread = Thread(name=f"{kind}_inventory_refresh", target=refresh)
+        refresh_thread.start()
+        succeeded, failed = self._extend_due(params, kind, cached_leases)
+        refresh_thread.join()
+        if "error" in refreshed:
+            logging.warning(f'Failed to refresh {kind} inventory, used cached list only.\n{refreshed["error"]}')
+            return list(cached_leases), succeeded, failed
+
+        leases = refreshed["leases"]
+        for name in [name for name in failed if name not in leases]:
+            logging.info(f'{kind} [{name}] no longer exists')
+            del failed[name]
+        new_leases = {name: expiry for name, expiry in leases.items() if name not in cached_leases}
+        if new_leases:
+            new_succeeded, new_failed = self._extend_due(params, kind, new_leases)
+            succeeded.extend(new_succeeded)
+            failed.update(new_failed)
+        return list(leases), succeeded, failed
+
+    def _lease_workflow(self, params, kind, get_leases):
+        explicit_name = params.testbed_name if kind == TESTBED else params.vm_name
+        location = NimbusLeaseExtend.get_location(params, kind == TESTBED)
+        cached_leases = None
+        if not explicit_name and not params.refresh:
+            cached_leases = self.inventory_cache.load(kind, params.user, location)
         try:
-            vm_names = self.get_vm_names(params)
-            for index, vm in enumerate(vm_names):
-                logging.info(f'Extending lease of VM [{vm}] ...')
-                if not params.dry_run:
-                    task_id = self._extend_vm_lease(args, vm)
-                    response = self._poll_task(task_id)
-                    if response:
-                        logging.info(f'Successfully extended lease for VM [{vm}]')
-            if len(vm_names) > 0:
-                success_message = f"Successfully extended lease for VMs: {vm_names}"
+            if cached_leases is not None:
+                names, succeeded, failed = self._extend_cached(params, kind, cached_leases, get_leases)
             else:
-                success_message = "No VMs found for extending lease."
-
-            logging.info(success_message)
-            with self.lock:
-                self.success_messages.append(success_message)
-            logging.info('*************** Finished VM Workflow *************')
+                leases = get_leases(params)
+                names = list(leases)
+                succeeded, failed = self._extend_due(params, kind, leases)
         except Exception as ex:
-            failure_message = f"Failed to extend lease for VMs: {vm_names[index:]}\n{ex}"
+            failure_message = f"Failed to get {kind}s for extending lease.\n{ex}"
             logging.error(failure_message)
             with self.lock:
                 self.failure_messages.append(failure_message)
-    
+            return
+        if succeeded and not params.dry_run:
+            # keep the cache from reporting extended leases as due until the next listing
+            expiry = time.time() + LEASE_DAYS * 24 * 60 * 60
+            self.inventory_cache.update(kind, params.user, location, {name: expiry for name in succeeded})
+        if succeeded:
+            success_message = f"Successfully extended lease for {kind}s: {succeeded}"
+        elif not names:
+            success_message = f"No {kind}s found for extending lease."
+        elif not failed:
+            success_message = f"No {kind}s due for extending lease."
+        else:
+            success_message = None
+        with self.lock:
+            if success_message:
+                logging.info(success_message)
+                self.success_messages.append(success_message)
+            if failed:
+                failure_message = f"Failed to extend lease for {kind}s: {list(failed)}\n{pformat(failed)}"
+                logging.error(failure_message)
+                self.failure_messages.append(failure_message)
+
+    def testbed_workflow(self, params):
+        self._lease_workflow(params, TESTBED, self.get_testbed_leases)
+        logging.info('*************** Finished Testbed Workflow *************')
+
+    def vm_workflow(self, params):
+        self._lease_workflow(params, VM, self.get_vm_leases)
+        logging.info('*************** Finished VM Workflow *************')
+
     def nimbus_lease_extend_workflow(self, params):
+        if self.resume_window:
+            self.already_extended = self.journal.succeeded_since(time.time() - self.resume_window)
         testbed_thread = Thread(name= "testbed_workflow", target=self.testbed_workflow, args=[params])
         vm_thread = Thread(name="vm_workflow", target=self.vm_workflow, args=[params])
         testbed_thread.start()
@@ -243,6 +700,123 @@ class NimbusLeaseExtend:
             raise RuntimeError(' '.join(self.failure_messages))
         logging.info('*************** Finished *************')
 
+    def run_daemon(self, params):
+        """
+        Runs the lease extend workflow forever, sleeping until the next lease
+        comes within the extend threshold between runs.
+
+        :param params: command-line args from main
+        """
+        while True:
+            self.success_messages = []
+            self.failure_messages = []
+            self.next_due = {}
+            failed = False
+            try:
+                self.nimbus_lease_extend_workflow(params)
+            except RuntimeError:
+                failed = True
+            if failed or self.failure_messages:
+                # failed leases are due already and not part of next_due
+                logging.error('Lease extend run had failures, retrying on the next wake up')
+                sleep = DAEMON_MIN_SLEEP
+            else:
+                next_due = min(self.next_due.values(), default=None)
+                sleep = DAEMON_MAX_SLEEP if next_due is None else next_due - time.time()
+            sleep = min(DAEMON_MAX_SLEEP, max(DAEMON_MIN_SLEEP, sleep))
+            logging.info(f'Next lease check in {sleep:.0f} seconds')
+            time.sleep(sleep)
+
+
+class NimbusBatchEngine:
+    """
+    asyncio engine that submits every extend request first and then polls all
+    outstanding task IDs from one event loop on a single cadence.
+    Blocking API calls run on an executor bounded by the extender's max_workers,
+    so thousands of in-flight tasks do not cost thousands of threads.
+    """
+    def __init__(self, extender):
+        self.extender = extender
+        self.poll_policy = extender.poll_policy
+        self.executor = None
+
+    async def _call(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    async def _submit(self, params, kind, name):
+        """
+        Returns tuple of (start time, end time, task id or the exception raised) of one submit
+        """
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        try:
+            task_id = await self._call(self.extender._submit_extend, params, kind, name)
+        except Exception as ex:
+            return start, loop.time(), ex
+        return start, loop.time(), task_id
+
+    async def _submit_all(self, params, kind, names, failed):
+        submits = await asyncio.gather(*(self._submit(params, kind, name) for name in names))
+        pending = {}
+        for name, (start, end, task_id) in zip(names, submits):
+            if isinstance(task_id, Exception):
+                logging.error(f'Failed to extend lease for {kind} [{name}]: {task_id}')
+                failed[name] = str(task_id)
+                self.extender.journal.record(kind, name, None, "FAILED", end - start, str(task_id))
+            else:
+                # name, start time, polls done, next poll due
+                pending[task_id] = [name, start, 0, end + self.poll_policy.interval(0)]
+        return pending
+
+    async def _poll_all(self, kind, pending, succeeded, failed):
+        loop = asyncio.get_running_loop()
+        while pending:
+            await asyncio.sleep(max(0, min(task[3] for task in pending.values()) - loop.time()))
+            now = loop.time()
+            due = [task_id for task_id, task in pending.items() if task[3] <= now]
+            results = await asyncio.gather(*(self._call(self.extender._get_task_status, task_id)
+                                             for task_id in due), return_exceptions=True)
+            now = loop.time()
+            for task_id, result in zip(due, results):
+                task = pending[task_id]
+                name, start = task[0], task[1]
+                task[2] += 1
+                if isinstance(result, Exception):
+                    status, error = "FAILED", str(result)
+                elif result[0] in ("SUCCEEDED", "FAILED"):
+                    status, error = result[0], 'Task status is FAILED' if result[0] == "FAILED" else None
+                elif now - start >= self.poll_policy.deadline:
+                    status, error = "FAILED", f'Timed out after {self.poll_policy.deadline} seconds'
+                else:
+                    task[3] = now + min(self.poll_policy.interval(task[2]),
+                                        start + self.poll_policy.deadline - now)
+                    continue
+                if error:
+                    logging.error(f'Failed to extend lease for {kind} [{name}]: {error}')
+                    failed[name] = error
+                else:
+                    logging.info(f'Successfully extended lease for {kind} [{name}]')
+                    succeeded.append(name)
+                self.extender._record_poll_stats(task_id, task[2], now - start)
+                self.extender.journal.record(kind, name, task_id, status, now - start, error)
+                del pending[task_id]
+            logging.debug(f'{len(pending)} {kind} tasks still running')
+
+    async def run(self, params, kind, names):
+        """
+        Returns tuple of (succeeded names, dict of failed name -> reason)
+
+        :param params: command-line args from main
+        :param kind: resource kind, either TESTBED or VM
+        :param names: names of resources to extend lease of
+        """
+        succeeded, failed = [], {}
+        with ThreadPoolExecutor(max_workers=self.extender.max_workers,
+                                thread_name_prefix=f'{kind}_async_worker') as self.executor:
+            pending = await self._submit_all(params, kind, list(names), failed)
+            await self._poll_all(kind, pending, succeeded, failed)
+        return succeeded, failed
+
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser("Nimbus lease extender")
@@ -263,13 +837,67 @@ if __name__ == '__main__':
                              ' are deployed. Overrides global --location flag for VMs')
     parser.add_argument('-d', '--dry-run', required=False, action="store_true",
                         help='Dry run the command. This does not calls the lease extend APIs')
+    parser.add_argument('-w', '--max-workers', type=int, default=MAX_WORKERS,
+                        help=f'Number of resources to extend lease of concurrently. Default is {MAX_WORKERS}')
+    parser.add_argument('-r', '--rate-limit', type=float, default=RATE_LIMIT,
+                        help=f'Maximum Nimbus API calls per second across all workers, 0 to disable. '
+                             f'Default is {RATE_LIMIT}')
+    parser.add_argument('-e', '--engine', choices=[THREAD_ENGINE, ASYNC_ENGINE], default=THREAD_ENGINE,
+                        help=f'{THREAD_ENGINE}: extend and poll each resource on its own worker. '
+                             f'{ASYNC_ENGINE}: submit all extends first, then poll every task from one event loop. '
+                             f'Default is {THREAD_ENGINE}')
+    parser.add_argument('--poll-initial', type=float, default=POLL_INITIAL,
+                        help=f'Seconds before the first task status poll. Default is {POLL_INITIAL}')
+    parser.add_argument('--poll-factor', type=float, default=POLL_FACTOR,
+                        help=f'Growth factor of the wait between task status polls. Default is {POLL_FACTOR}')
+    parser.add_argument('--poll-max-interval', type=float, default=DELAY,
+                        help=f'Maximum seconds between task status polls. Default is {DELAY}')
+    parser.add_argument('--poll-jitter', type=float, default=POLL_JITTER,
+                        help=f'Random +/- fraction applied to each poll wait. Default is {POLL_JITTER}')
+    parser.add_argument('--poll-deadline', type=float, default=TIMEOUT,
+                        help=f'Seconds after which a still running task is reported failed. Default is {TIMEOUT}')
+    parser.add_argument('--cache-ttl', type=int, default=INVENTORY_TTL,
+                        help=f'Seconds a cached testbed/VM listing is reused before listing again, 0 to disable. '
+                             f'Default is {INVENTORY_TTL}')
+    parser.add_argument('--refresh', required=False, action="store_true",
+                        help='Ignore the cached testbed/VM listing and list resources from Nimbus first')
+    parser.add_argument('--extend-within', type=float, default=0,
+                        help='Only extend resources whose lease expires within this many hours, soonest first. '
+                             'Resources with unknown expiry are always extended. Default is 0, extend everything')
+    parser.add_argument('--daemon', required=False, action="store_true",
+                        help='Keep running and wake up when the next lease comes within --extend-within hours')
+    parser.add_argument('--journal', required=False,
+                        help=f'JSONL file receiving one record per resource as it completes. '
+                             f'Default is {OUT_DIR}/{JOURNAL_FILE} next to this script')
+    parser.add_argument('--resume', type=float, default=0, metavar='HOURS',
+                        help='Skip resources the journal shows were extended within the last HOURS hours')
+    parser.add_argument('--api-base-url', required=False,
+                        help=f'Nimbus API base URL. Defaults to $NIMBUS_API_BASE_URL or {NIMBUS_API_BASE_URL}')
+    parser.add_argument('--connect-timeout', type=float, default=CONNECT_TIMEOUT,
+                        help=f'Nimbus API connect timeout in seconds. Default is {CONNECT_TIMEOUT}')
+    parser.add_argument('--read-timeout', type=float, default=READ_TIMEOUT,
+                        help=f'Nimbus API read timeout in seconds. Default is {READ_TIMEOUT}')
+    parser.add_argument('--http-retries', type=int, default=HTTP_RETRIES,
+                        help=f'Retries with backoff on Nimbus API connection errors and 5xx. Default is {HTTP_RETRIES}')
 
     args = parser.parse_args()
     if not args.location and not all([args.vm_location, args.testbed_location]):
         parser.error("Either specify --location or both --vm-location and --testbed-location")
+    if args.daemon and not args.extend_within:
+        parser.error("--daemon requires --extend-within")
     logging.basicConfig(format='%(asctime)s - %(name)s - %(threadName)s - %(levelname)s - %(message)s', level=logging.DEBUG)
     logging.getLogger("urllib3.connectionpool").setLevel(logging.WARN)
-    logging.getLogger("retry.api").setLevel(logging.WARN)
 
-    lease_extender = NimbusLeaseExtend()
-    lease_extender.nimbus_lease_extend_workflow(args)
+    lease_extender = NimbusLeaseExtend(max_workers=args.max_workers, rate_limit=args.rate_limit,
+                                       connect_timeout=args.connect_timeout, read_timeout=args.read_timeout,
+                                       retries=args.http_retries, engine=args.engine,
+                                       poll_policy=PollPolicy(initial=args.poll_initial, factor=args.poll_factor,
+                                                              max_interval=args.poll_max_interval,
+                                                              jitter=args.poll_jitter, deadline=args.poll_deadline),
+                                       inventory_ttl=args.cache_ttl, extend_threshold=args.extend_within * 60 * 60,
+                                       journal_path=args.journal, resume_window=args.resume * 60 * 60,
+                                       api_base_url=args.api_base_url)
+    if args.daemon:
+        lease_extender.run_daemon(args)
+    else:
+        lease_extender.nimbus_lease_extend_workflow(args)
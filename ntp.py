@@ -1,16 +1,108 @@
+import argparse
+import json
+import math
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
 from time import ctime, time, sleep, asctime, strftime
 
 import ntplib
 
+from metrics_util import METRICS
+
+NTP_POOL = ['time.vmware.com', '0.vmware.pool.ntp.org']# 'ntp1.eng.vmware.com', '10.173.57.2','10.110.75.20', '10.147.7.22']
+SAMPLES = 4
+TIMEOUT = 2
+SAMPLE_INTERVAL = 0.05
+
+
+def sample_ntp_server(server, samples=SAMPLES, timeout=TIMEOUT, port=123, version=3):
+    """
+    Returns dictionary describing the best of several samples from one NTP server:
+    offset, delay and dispersion of the lowest delay sample, jitter across samples
+    and the count of samples answered. Failed samples after the first answer are skipped;
+    it raises as soon as the first sample fails, so a dead server costs a single timeout.
+
+    :param server: NTP server name or address, optionally as host:port
+    :param samples: number of requests sent to the server
+    :param timeout: timeout of each request in seconds
+    :param port: NTP port. Default is 123
+    :param version: NTP version. Default is 3
+    """
+    if server.count(':') == 1:
+        server, port = server.split(':')
+        port = int(port)
+    client = ntplib.NTPClient()
+    responses = []
+    error = None
+    for index in range(samples):
+        if index:
+            sleep(SAMPLE_INTERVAL)
+        try:
+            with METRICS.timer("ntp_request_seconds"):
+                response = client.request(server, version=version, port=port, timeout=timeout)
+            METRICS.observe("ntp_delay_seconds", response.delay)
+            responses.append(response)
+        except (ntplib.NTPException, OSError) as ex:
+            # a dropped UDP reply says little about the next one
+            METRICS.inc("ntp_request_errors_total")
+            error = ex
+            # a server that never answered is likely down, do not wait out the remaining samples
+            if not responses:
+                break
+    if not responses:
+        raise ntplib.NTPException("%s: %s" % (server, error))
+    # the lowest round-trip delay sample has the least asymmetric network error
+    best = min(responses, key=lambda response: response.delay)
+    jitter = math.sqrt(sum((response.offset - best.offset) ** 2 for response in responses) / len(responses))
+    return {"offset": best.offset, "delay": best.delay,
+            "dispersion": best.root_dispersion + best.root_delay / 2, "jitter": jitter,
+            "stratum": best.stratum, "samples": len(responses)}
+
+
+def query_ntp_pool(servers=NTP_POOL, samples=SAMPLES, timeout=TIMEOUT, port=123, max_delay=None):
+    """
+    Queries all servers concurrently and returns the chosen clock offset as a dictionary:
+    offset, delay, dispersion and jitter of the best server, the server name and
+    per-server results (or errors) under "servers". offset is None if no server answered.
+
+    :param servers: NTP server names or addresses, optionally as host:port
+    :param samples: number of requests sent to each server
+    :param timeout: timeout of each request in seconds
+    :param port: NTP port. Default is 123
+    :param max_delay: ignore servers whose best round-trip delay is above this many seconds
+    """
+    results = {}
+    with ThreadPoolExecutor(max_workers=max(1, len(servers))) as pool:
+        futures = {server: pool.submit(sample_ntp_server, server, samples, timeout, port) for server in servers}
+        for server, future in futures.items():
+            try:
+                results[server] = future.result()
+            except ntplib.NTPException as ex:
+                results[server] = {"error": str(ex)}
+    candidates = {server: result for server, result in results.items()
+                  if "error" not in result and (max_delay is None or result["delay"] <= max_delay)}
+    chosen = {"offset": None, "delay": None, "dispersion": None, "jitter": None, "server": None, "servers": results}
+    if not candidates:
+        return chosen
+    # pick the server with the smallest synchronization distance
+    server = min(candidates, key=lambda name: candidates[name]["delay"] / 2 + candidates[name]["dispersion"])
+    offsets = [result["offset"] for result in candidates.values()]
+    mean = sum(offsets) / len(offsets)
+    chosen.update(offset=candidates[server]["offset"], delay=candidates[server]["delay"],
+                  dispersion=candidates[server]["dispersion"], server=server,
+                  jitter=math.sqrt(sum((offset - mean) ** 2 for offset in offsets) / len(offsets)))
+    return chosen
+
 
 def get_ntp_time():
-    ntp_pool = ['time.vmware.com', '0.vmware.pool.ntp.org']# 'ntp1.eng.vmware.com', '10.173.57.2','10.110.75.20', '10.147.7.22']
+    ntp_pool = NTP_POOL
     try:
         for item in ntp_pool:
             print(item)
             call = ntplib.NTPClient()
-            response = call.request(item, version=3)
+            with METRICS.timer("ntp_request_seconds"):
+                response = call.request(item, version=3)
+            METRICS.observe("ntp_delay_seconds", response.delay)
             times = {"tx":response.tx_time,"recv":response.recv_time,
                      "orig":response.orig_time, "sys":time(),
                      "offset":response.offset, "dest":response.dest_time}
@@ -35,4 +127,19 @@ def uk_ntp():
     print (datetime.fromtimestamp(response.tx_time, timezone.utc))
 
 
-get_ntp_time()
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser("NTP util")
+    parser.add_argument('servers', nargs='*', default=NTP_POOL, help="NTP servers. Default is %s" % NTP_POOL)
+    parser.add_argument('-s', '--samples', type=int, default=SAMPLES,
+                        help="Requests per server. Default is %s" % SAMPLES)
+    parser.add_argument('-t', '--timeout', type=float, default=TIMEOUT,
+                        help="Timeout of each request in seconds. Default is %s" % TIMEOUT)
+    parser.add_argument('-p', '--port', type=int, default=123, help="NTP port. Default is 123")
+    parser.add_argument('-d', '--max-delay', type=float, default=None,
+                        help="Ignore servers whose round-trip delay is above this many seconds")
+    args = parser.parse_args()
+
+    result = query_ntp_pool(args.servers, args.samples, args.timeout, args.port, args.max_delay)
+    print(json.dumps(result, indent=2))
+    if result["offset"] is None:
+        raise SystemExit(1)
@@ -0,0 +1,108 @@
+"""
+Fake local NTP responder for testing ntp.py offline.
+
+Answers NTP client requests with a configurable clock offset and network delay,
+and can drop a fraction of requests to act like a slow or dead server.
+
+    python3 ntp_stub.py --port 12300 --offset 1.5 --delay 0.01
+    python3 ntp.py 127.0.0.1 --port 12300
+"""
+
+import argparse
+import random
+import socket
+from threading import Thread
+from time import sleep, time
+
+import ntplib
+
+
+class FakeNTPServer:
+    def __init__(self, host='127.0.0.1', port=0, offset=0.0, delay=0.0, drop_rate=0.0, stratum=2):
+        """
+        :param host: address to listen on. Default is 127.0.0.1
+        :param port: UDP port, 0 picks a free one
+        :param offset: seconds added to the local clock in replies
+        :param delay: round-trip network delay in seconds, half before the request
+                      is timestamped and half after the reply is
+        :param drop_rate: fraction of requests left unanswered
+        :param stratum: stratum reported in replies
+        """
+        self.offset = offset
+        self.delay = delay
+        self.drop_rate = drop_rate
+        self.stratum = stratum
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind((host, port))
+        self.thread = None
+        self.running = False
+
+    @property
+    def address(self):
+        return self.sock.getsockname()
+
+    def _now(self):
+        return ntplib.system_to_ntp_time(time() + self.offset)
+
+    def _reply(self, data, client):
+        request = ntplib.NTPPacket()
+        request.from_data(data)
+        reply = ntplib.NTPPacket(version=request.version, mode=4)
+        reply.stratum = self.stratum
+        reply.orig_timestamp = request.tx_timestamp
+        # time spent outside the receive and transmit timestamps counts as network
+        # delay for the client; time between them would be subtracted as server time
+        if self.delay:
+            sleep(self.delay / 2)
+        reply.recv_timestamp = self._now()
+        reply.ref_timestamp = reply.recv_timestamp
+        reply.tx_timestamp = self._now()
+        data = reply.to_data()
+        if self.delay:
+            sleep(self.delay / 2)
+        self.sock.sendto(data, client)
+
+    def serve_forever(self):
+        self.running = True
+        self.sock.settimeout(0.2)
+        while self.running:
+            try:
+                data, client = self.sock.recvfrom(256)
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            if self.drop_rate and random.random() < self.drop_rate:
+                continue
+            try:
+                self._reply(data, client)
+            except ntplib.NTPException:
+                continue
+
+    def start(self):
+        self.thread = Thread(name="fake_ntp_server", target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.running = False
+        if self.thread:
+            self.thread.join()
+        self.sock.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser("Fake NTP server")
+    parser.add_argument('--host', default='127.0.0.1', help="Address to listen on. Default is 127.0.0.1")
+    parser.add_argument('-p', '--port', type=int, default=12300, help="UDP port. Default is 12300")
+    parser.add_argument('-o', '--offset', type=float, default=0.0, help="Clock offset in seconds. Default is 0")
+    parser.add_argument('-d', '--delay', type=float, default=0.0, help="Round-trip network delay in seconds. Default is 0")
+    parser.add_argument('--drop-rate', type=float, default=0.0, help="Fraction of requests dropped. Default is 0")
+    args = parser.parse_args()
+
+    server = FakeNTPServer(args.host, args.port, args.offset, args.delay, args.drop_rate)
+    print("Fake NTP server listening on %s:%s" % server.address)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.stop()
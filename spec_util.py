@@ -1,81 +1,392 @@
+"""
+Generates bringup/add-host/remove-host/add-cluster/remove-cluster JSON specs from templates.
+
+Each operation has a JSON template in TEMPLATE_DIR named after its spec prefix, eg. bringup.json.
+String values may use ${name} placeholders. Per-host placeholders are ${esx_ip}, ${esx_hostname},
+${host_index} (0 based) and ${host_number} (the last IP offset). ${esx_ip_start} and ${esx_count}
+are the scenario's ip_start and esx_count; every other name, eg. ${domain}, comes from the scenario values. A list holding a single item that uses
+per-host placeholders is repeated once per ESXi host:
+
+	{"hostSpecs": [{"hostname": "${esx_hostname}.${domain}", "ipAddress": "${esx_ip}"}]}
+
+A string made of one placeholder only is replaced by the JSON value as is, so "${esx_count}" becomes a number.
+Templates are parsed and compiled once per run, specs are streamed to disk and a spec is only
+rewritten when its template or values changed.
+"""
+
 import argparse
-import re
+import hashlib
+import ipaddress
 import json
 import os
+import re
+
+from metrics_util import METRICS
 
 
 SPEC_DIR = '/tmp/specs'
+TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'spec_templates')
 BRINGUP_SPEC_PREFIX = 'bringup'
 ADD_HOST_SPEC_PREFIX = 'add-host'
 REMOVE_HOST_SPEC_PREFIX = 'remove-host'
 ADD_CLUSTER_SPEC_PREFIX = 'add-cluster'
 REMOVE_CLUSTER_SPEC_PREFIX = 'remove-cluster'
 ESX_IP_START = 4
+ESX_IP_BASE = '10.0.0.0'
+ESX_HOSTNAME_FORMAT = 'esx-%02d'
+HASH_SUFFIX = '.sha256'
+INDENT = '  '
+HOST_PLACEHOLDERS = {'esx_ip', 'esx_hostname', 'host_index', 'host_number'}
+# set from the ip_start and esx_count arguments
+RESERVED_VALUES = {'esx_ip_start', 'esx_count'}
+PLACEHOLDER_RE = re.compile(r'\$\{(\w+)\}')
+
+
+class _Slot:
+	"""
+	Precompiled string value with placeholders
+	"""
+
+	def __init__(self, text):
+		# alternating literal text and placeholder names, starting and ending with literal text
+		self.pieces = PLACEHOLDER_RE.split(text)
+		self.names = set(self.pieces[1::2])
+		self.whole = self.pieces[0] == '' and self.pieces[-1] == '' and len(self.pieces) == 3
+
+	def render(self, values):
+		if self.whole:
+			return json.dumps(values[self.pieces[1]])
+		pieces = self.pieces[:]
+		for index in range(1, len(pieces), 2):
+			pieces[index] = str(values[pieces[index]])
+		return json.dumps(''.join(pieces))
+
+
+class _HostLoop:
+	"""
+	Precompiled list item repeated once per ESXi host
+	"""
+
+	def __init__(self, parts, depth):
+		self.parts = parts
+		self.open = '[\n' + INDENT * (depth + 1)
+		self.separator = ',\n' + INDENT * (depth + 1)
+		self.close = '\n' + INDENT * depth + ']'
+
+
+class SpecTemplate:
+	"""
+	JSON template parsed once and compiled into literal JSON text, placeholder slots
+	and per-host loops, so rendering a spec only formats the substitution points.
+	"""
+
+	def __init__(self, template_file):
+		with open(template_file, 'rb') as fin:
+			data = fin.read()
+		self.template_file = template_file
+		self.digest = hashlib.sha256(data).hexdigest()
+		self.names = set()
+		self.parts = self._merge(self._compile(json.loads(data), 0, False))
+		self.names -= HOST_PLACEHOLDERS
+
+	@staticmethod
+	def _uses_host(node):
+		if isinstance(node, str):
+			return bool(HOST_PLACEHOLDERS.intersection(PLACEHOLDER_RE.findall(node)))
+		if isinstance(node, dict):
+			return any(SpecTemplate._uses_host(value) for value in node.values())
+		if isinstance(node, list):
+			return any(SpecTemplate._uses_host(value) for value in node)
+		return False
+
+	@staticmethod
+	def _merge(parts):
+		# join neighbouring literal text so rendering yields as few pieces as possible
+		merged = []
+		for part in parts:
+			if isinstance(part, str) and merged and isinstance(merged[-1], str):
+				merged[-1] += part
+			else:
+				merged.append(part)
+		return merged
+
+	def _compile(self, node, depth, in_loop):
+		indent = INDENT * (depth + 1)
+		if isinstance(node, dict):
+			if not node:
+				return ['{}']
+			parts = ['{']
+			for index, (key, value) in enumerate(node.items()):
+				parts.append('%s\n%s%s: ' % (',' if index else '', indent, json.dumps(key)))
+				parts.extend(self._compile(value, depth + 1, in_loop))
+			parts.append('\n' + INDENT * depth + '}')
+			return parts
+		if isinstance(node, list):
+			if not in_loop and len(node) == 1 and self._uses_host(node[0]):
+				return [_HostLoop(self._merge(self._compile(node[0], depth + 1, True)), depth)]
+			if not node:
+				return ['[]']
+			parts = ['[']
+			for index, value in enumerate(node):
+				parts.append('%s\n%s' % (',' if index else '', indent))
+				parts.extend(self._compile(value, depth + 1, in_loop))
+			parts.append('\n' + INDENT * depth + ']')
+			return parts
+		if isinstance(node, str) and PLACEHOLDER_RE.search(node):
+			slot = _Slot(node)
+			if not in_loop and slot.names & HOST_PLACEHOLDERS:
+				raise ValueError("%s: per-host placeholders are only allowed inside a single item list: %s"
+								 % (self.template_file, node))
+			self.names |= slot.names
+			return [slot]
+		return [json.dumps(node)]
 
+	def render(self, values, hosts):
+		"""
+		Yields the spec as JSON text pieces
 
-def generate_bringup_spec(ip_start, esx_count = 3):
+		:param values: placeholder values shared by the whole spec
+		:param hosts: list of per-host placeholder values
+		"""
+		return self._render(self.parts, values, hosts)
+
+	def _render(self, parts, values, hosts):
+		for part in parts:
+			if isinstance(part, str):
+				yield part
+			elif isinstance(part, _Slot):
+				yield part.render(values)
+			elif not hosts:
+				yield '[]'
+			else:
+				yield part.open
+				for index, host in enumerate(hosts):
+					if index:
+						yield part.separator
+					host_values = dict(values, **host)
+					yield from self._render(part.parts, host_values, None)
+				yield part.close
+
+
+class SpecGenerator:
+	"""
+	Renders spec files from the templates in template_dir. Each template is loaded
+	and compiled once, and a spec whose template and values are unchanged since it
+	was last written is left alone.
+	"""
+
+	def __init__(self, template_dir=TEMPLATE_DIR, spec_dir=SPEC_DIR, values=None, force=False):
+		"""
+		:param template_dir: directory with <spec prefix>.json templates
+		:param spec_dir: directory the specs are written to
+		:param values: placeholder values shared by every spec
+		:param force: rewrite specs even if they are up to date
+		"""
+		self.template_dir = template_dir
+		self.spec_dir = spec_dir
+		self.values = values or {}
+		self.force = force
+		self.templates = {}
+		self.generated = 0
+		self.skipped = 0
+
+	def get_template(self, operation):
+		if operation not in self.templates:
+			template_file = os.path.join(self.template_dir, operation + '.json')
+			if not os.path.exists(template_file):
+				raise IOError("No %s template, expected %s" % (operation, template_file))
+			self.templates[operation] = SpecTemplate(template_file)
+		return self.templates[operation]
+
+	@staticmethod
+	def get_hosts(ip_start, esx_count, ip_base=ESX_IP_BASE, hostname_format=ESX_HOSTNAME_FORMAT):
+		"""
+		Returns list of per-host placeholder values
+		:param ip_start: ESXi IP start value. eg if ip_start=4 and esx_count=3, then esxi IPs will be x.x.x.4, x.x.x.5 and x.x.x.6
+		:param esx_count: Number of ESXi hosts
+		:param ip_base: network address the IP start value is added to
+		:param hostname_format: %-format for the hostname, applied to the host number
+		"""
+		base = int(ipaddress.ip_address(ip_base))
+		return [{'esx_ip': str(ipaddress.ip_address(base + number)), 'esx_hostname': hostname_format % number,
+				 'host_index': index, 'host_number': number}
+				for index, number in enumerate(range(ip_start, ip_start + esx_count))]
+
+	def generate(self, operation, ip_start=ESX_IP_START, esx_count=3, values=None, name=None):
+		"""
+		Return spec file path
+		:param operation: spec prefix, selects the template
+		:param ip_start: ESXi IP start value
+		:param esx_count: Number of ESXi hosts
+		:param values: placeholder values on top of the shared ones; esx_ip_base and esx_hostname_format change the per-host values
+		:param name: spec file name without .json. Default is <operation>-<esx_count>-host
+		"""
+		template = self.get_template(operation)
+		values = dict(self.values, **(values or {}))
+		reserved = sorted(RESERVED_VALUES & values.keys())
+		if reserved:
+			raise ValueError("%s cannot be given as values, set the scenario's ip_start and esx_count instead" % ", ".join(reserved))
+		values.update(esx_ip_start=ip_start, esx_count=esx_count)
+		values.setdefault('esx_ip_base', ESX_IP_BASE)
+		values.setdefault('esx_hostname_format', ESX_HOSTNAME_FORMAT)
+		missing = template.names - values.keys()
+		if missing:
+			raise ValueError("No value for %s in %s" % (", ".join(sorted(missing)), template.template_file))
+		spec_path = os.path.join(self.spec_dir, (name or '%s-%s-host' % (operation, esx_count)) + '.json')
+
+		digest = hashlib.sha256(json.dumps([template.digest, values], sort_keys=True, default=str).encode()).hexdigest()
+		try:
+			with open(spec_path + HASH_SUFFIX) as fin:
+				up_to_date = not self.force and fin.read().strip() == digest and os.path.exists(spec_path)
+		except IOError:
+			up_to_date = False
+		if up_to_date:
+			self.skipped += 1
+			METRICS.inc('spec_skipped_total', labels={'operation': operation})
+			return spec_path
+
+		hosts = self.get_hosts(ip_start, esx_count, values['esx_ip_base'], values['esx_hostname_format'])
+		os.makedirs(self.spec_dir, exist_ok=True)
+		tmp_path = "%s.%s.tmp" % (spec_path, os.getpid())
+		try:
+			with METRICS.timer('spec_render_seconds', {'operation': operation}):
+				with open(tmp_path, 'w') as fout:
+					fout.writelines(template.render(values, hosts))
+					fout.write('\n')
+			os.replace(tmp_path, spec_path)
+		except IOError as err:
+			if os.path.exists(tmp_path):
+				os.remove(tmp_path)
+			raise err
+		with open(spec_path + HASH_SUFFIX, 'w') as fout:
+			fout.write(digest)
+		self.generated += 1
+		return spec_path
+
+	def generate_batch(self, scenarios):
+		"""
+		Returns dictionary of scenario name to spec file path
+		:param scenarios: list of dicts with operation and optional ip_start, esx_count, values and name
+		"""
+		specs = dict()
+		for scenario in scenarios:
+			name = scenario.get('name') or '%s-%s-host' % (scenario['operation'], scenario.get('esx_count', 3))
+			if name in specs:
+				raise ValueError("Two scenarios write the spec %s, give them distinct names" % name)
+			specs[name] = self.generate(scenario['operation'], scenario.get('ip_start', ESX_IP_START),
+										scenario.get('esx_count', 3), scenario.get('values'), name)
+		return specs
+
+
+SPEC_GENERATOR = SpecGenerator()
+
+
+def generate_bringup_spec(ip_start, esx_count = 3, generator=None):
 	"""
 	Return bringup spec file path
 	:param ip_start: ESXi IP start value. eg if ip_start=4 and esx_count=3, then esxi IPs will be x.x.x.4, x.x.x.5 and x.x.x.6
 	:param esx_count: Number of ESXi hosts for bringup operation
+	:param generator: SpecGenerator to use. Default is SPEC_GENERATOR
 	"""
-	spec_path = os.path.join(SPEC_DIR, BRINGUP_SPEC_PREFIX + '-%s-host.json' % esx_count)
-	try:
-		with open 
-	except IOError as err:
-		raise err
-	except Exception as e:
-		raise e
-	return spec_path
+	return (generator or SPEC_GENERATOR).generate(BRINGUP_SPEC_PREFIX, ip_start, esx_count)
 
 
-def generate_add_host_spec(ip_start, esx_count = 3):
+def generate_add_host_spec(ip_start, esx_count = 3, generator=None):
 	"""
 	Return add-host spec file path
 	:param ip_start: ESXi IP start value. eg if ip_start=4 and esx_count=3, then esxi IPs will be x.x.x.4, x.x.x.5 and x.x.x.6
 	:param esx_count: Number of ESXi hosts for add-host operation
+	:param generator: SpecGenerator to use. Default is SPEC_GENERATOR
 	"""
+	return (generator or SPEC_GENERATOR).generate(ADD_HOST_SPEC_PREFIX, ip_start, esx_count)
 
 
-def generate_remove_host_spec():
-	pass
+def generate_remove_host_spec(ip_start, esx_count = 3, generator=None):
+	"""
+	Return remove-host spec file path
+	:param ip_start: IP start value of the first ESXi host to remove
+	:param esx_count: Number of ESXi hosts for remove-host operation
+	:param generator: SpecGenerator to use. Default is SPEC_GENERATOR
+	"""
+	return (generator or SPEC_GENERATOR).generate(REMOVE_HOST_SPEC_PREFIX, ip_start, esx_count)
 
 
-def generate_add_cluster_spec():
-	pass
+def generate_add_cluster_spec(ip_start, esx_count = 3, generator=None):
+	"""
+	Return add-cluster spec file path
+	:param ip_start: ESXi IP start value of the new cluster hosts
+	:param esx_count: Number of ESXi hosts in the new cluster
+	:param generator: SpecGenerator to use. Default is SPEC_GENERATOR
+	"""
+	return (generator or SPEC_GENERATOR).generate(ADD_CLUSTER_SPEC_PREFIX, ip_start, esx_count)
 
 
-def generate_remove_cluster_spec():
-	pass
+def generate_remove_cluster_spec(ip_start, esx_count = 3, generator=None):
+	"""
+	Return remove-cluster spec file path
+	:param ip_start: ESXi IP start value of the cluster hosts
+	:param esx_count: Number of ESXi hosts in the cluster
+	:param generator: SpecGenerator to use. Default is SPEC_GENERATOR
+	"""
+	return (generator or SPEC_GENERATOR).generate(REMOVE_CLUSTER_SPEC_PREFIX, ip_start, esx_count)
 
 
-def generate_spec(args):
+def generate_spec(args, generator=None):
 	"""
 	Returns dictionary of spec file paths
 	:param args: command-line args from main
+	:param generator: SpecGenerator to use. Default is SPEC_GENERATOR
 	"""
 	spec = dict()
-	spec["bringup_spec"] = generate_bringup_spec(ip_start=ESX_IP_START, esx_count=args.bringup_host_count)
+	spec["bringup_spec"] = generate_bringup_spec(ip_start=ESX_IP_START, esx_count=args.bringup_host_count, generator=generator)
+	# hosts added, removed or clustered after bringup take the IPs following the bringup hosts
+	ip_start = ESX_IP_START + args.bringup_host_count
 	if args.add_host:
-		spec["add_host_spec"] = generate_add_host_spec(ip_start=ESX_IP_START + args.bringup_host_count, esx_count=args.add_host_count)
+		spec["add_host_spec"] = generate_add_host_spec(ip_start=ip_start, esx_count=args.add_host_count, generator=generator)
 	elif args.remove_host:
-		spec["remove_host_spec"] = generate_remove_host_spec()
+		spec["remove_host_spec"] = generate_remove_host_spec(ip_start=ip_start, esx_count=args.add_host_count, generator=generator)
 	elif args.add_cluster:
-		spec["add_cluster_spec"] = generate_add_cluster_spec()
+		spec["add_cluster_spec"] = generate_add_cluster_spec(ip_start=ip_start, esx_count=args.add_host_count, generator=generator)
 	elif args.remove_cluster:
-		spec["remove_cluster_spec"] = generate_remove_cluster_spec()
+		spec["remove_cluster_spec"] = generate_remove_cluster_spec(ip_start=ip_start, esx_count=args.add_host_count, generator=generator)
 	return spec
 
 
+def parse_values(pairs):
+	"""
+	Returns dictionary of placeholder values from name=value strings; values are parsed as JSON when possible
+	"""
+	values = dict()
+	for pair in pairs or []:
+		key, sep, value = pair.partition('=')
+		if not sep:
+			raise ValueError("Expected name=value, got %s" % pair)
+		try:
+			values[key] = json.loads(value)
+		except ValueError:
+			values[key] = value
+	return values
+
+
 if __name__ == '__main__':
 	parser = argparse.ArgumentParser("Spec util")
-	parser.add()
-	parser.add_argument('-n', '--bringup-host-count', action='store', default=3, help="Number of ESXi hosts to generate the bringup spec for. Default is 3 hosts")
-	parser.add_argument('-N', '--add-host-count', action='store', default=3, help="Number of ESXi hosts to generate the add-host spec for. Default is 3 hosts")
+	parser.add_argument('-n', '--bringup-host-count', type=int, default=3, help="Number of ESXi hosts to generate the bringup spec for. Default is 3 hosts")
+	parser.add_argument('-N', '--add-host-count', type=int, default=3, help="Number of ESXi hosts to generate the add-host, remove-host, add-cluster or remove-cluster spec for. Default is 3 hosts")
 	parser.add_argument('-a', '--add-host', action='store_true', default=False, help="Generate add-host spec")
-	parser.add_argument('-r', '--remove-host', action='store_true', default=False, help="Generate remove-cluster spec")
+	parser.add_argument('-r', '--remove-host', action='store_true', default=False, help="Generate remove-host spec")
 	parser.add_argument('-A', '--add-cluster', action='store_true', default=False, help="Generate add-cluster spec")
 	parser.add_argument('-R', '--remove-cluster', action='store_true', default=False, help="Generate remove-cluster spec")
+	parser.add_argument('-s', '--scenarios', default=None, help="JSON file with a list of {operation, ip_start, esx_count, values, name} to generate in one batch")
+	parser.add_argument('-t', '--template-dir', default=TEMPLATE_DIR, help="Directory with <operation>.json templates. Default is %s" % TEMPLATE_DIR)
+	parser.add_argument('-d', '--spec-dir', default=SPEC_DIR, help="Directory the specs are written to. Default is %s" % SPEC_DIR)
+	parser.add_argument('-v', '--value', action='append', default=[], help="Placeholder value as name=value, can be repeated")
+	parser.add_argument('-f', '--force', action='store_true', default=False, help="Rewrite specs even if they are up to date")
 	args = parser.parse_args()
 
-	generate_spec(args)
+	generator = SpecGenerator(args.template_dir, args.spec_dir, parse_values(args.value), args.force)
+	if args.scenarios:
+		with open(args.scenarios) as fin:
+			specs = generator.generate_batch(json.load(fin))
+	else:
+		specs = generate_spec(args, generator)
+	print(json.dumps(specs, indent=2))
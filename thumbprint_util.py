@@ -1,7 +1,22 @@
+import argparse
+import base64
 import hashlib
+import json
+import os
+import socket
 import ssl
 import subprocess
 import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from enum import Enum
+from threading import Lock
+
+from metrics_util import METRICS
+
+DEFAULT_TIMEOUT = 5
+MAX_WORKERS = 64
+CERT_CACHE_TTL = 60 * 60
 
 
 class Encryption(str, Enum):
@@ -10,6 +25,83 @@ class Encryption(str, Enum):
     MD5 = "md5"
 
 
+class CertCache:
+	"""
+	TTL cache of DER certificates keyed by (host, port), kept in memory and
+	optionally persisted to a JSON file so later runs skip the TLS handshake too.
+	"""
+
+	def __init__(self, ttl=CERT_CACHE_TTL, cache_file=None):
+		self.ttl = ttl
+		self.cache_file = cache_file
+		self.certs = {}
+		self.dirty = False
+		self.lock = Lock()
+		if cache_file:
+			self._load()
+
+	def _load(self):
+		try:
+			with open(self.cache_file) as fin:
+				saved = json.load(fin)
+		except (IOError, ValueError):
+			return
+		for key, entry in saved.items():
+			host, _, port = key.rpartition(":")
+			self.certs[(host, int(port))] = (entry["fetched"], base64.b64decode(entry["der"]))
+
+	def save(self):
+		"""
+		Writes the cache to cache_file if it changed since the last save
+		"""
+		with self.lock:
+			if not self.cache_file or not self.dirty:
+				return
+			saved = {"%s:%s" % key: {"fetched": fetched, "der": base64.b64encode(der).decode()}
+					 for key, (fetched, der) in self.certs.items() if time.time() - fetched < self.ttl}
+			os.makedirs(os.path.dirname(os.path.abspath(self.cache_file)), exist_ok=True)
+			tmp_file = "%s.%s.tmp" % (self.cache_file, os.getpid())
+			with open(tmp_file, "w") as fout:
+				json.dump(saved, fout)
+			os.replace(tmp_file, self.cache_file)
+			self.dirty = False
+
+	def get(self, hostname, port=443):
+		"""
+		Returns cached DER certificate, or None if missing or older than ttl
+		"""
+		with self.lock:
+			entry = self.certs.get((hostname, port))
+		if entry and time.time() - entry[0] < self.ttl:
+			return entry[1]
+		return None
+
+	def put(self, hostname, port, der_cert_bin):
+		with self.lock:
+			self.certs[(hostname, port)] = (time.time(), der_cert_bin)
+			self.dirty = True
+
+	def get_or_fetch(self, hostname, port=443, timeout=DEFAULT_TIMEOUT, refresh=False):
+		"""
+		Returns DER certificate from the cache, connecting only when it is missing, expired or refresh is set
+		"""
+		der_cert_bin = None if refresh else self.get(hostname, port)
+		if der_cert_bin is None:
+			der_cert_bin = get_der_cert(hostname, port, timeout)
+			self.put(hostname, port, der_cert_bin)
+		else:
+			METRICS.inc("tls_cert_cache_hits_total")
+		return der_cert_bin
+
+	def clear(self):
+		with self.lock:
+			self.certs.clear()
+			self.dirty = True
+
+
+CERT_CACHE = CertCache()
+
+
 def get_thumbprint_cmd(hostname, port=443, algorithm: Encryption = Encryption.SHA256):
 	"""
 	Returns SSL thumbprint for specified host using openssl cmd
@@ -29,40 +121,121 @@ def get_thumbprint_cmd(hostname, port=443, algorithm: Encryption = Encryption.SH
 		raise e
 
 
-def get_pem_cert(address, port=443):
+def get_pem_cert(address, port=443, refresh=False, cache=None):
 	"""
 	Returns certificate for specified host in pem format
 
 	:param adddress: FQDN or IP of the host
 	:param port: port number of the host. Default is 443
+	:param refresh: reconnect even if the certificate is cached
+	:param cache: CertCache to use. Default is the in-memory CERT_CACHE
 	"""
-    try:
-        cert = ssl.get_server_certificate((address, port))
-    except Exception as ex:
-        raise Exception(f"Failed to connect to address: {address}. Exception: {ex}")
-    return cert
+	cache = cache or CERT_CACHE
+	der_cert_bin = cache.get_or_fetch(address, port, refresh=refresh)
+	cache.save()
+	return ssl.DER_cert_to_PEM_cert(der_cert_bin)
 
 
-def get_thumbprint(hostname, port=443, algorithm: Encryption = Encryption.SHA256):
+def get_thumbprint(hostname, port=443, algorithm: Encryption = Encryption.SHA256, refresh=False, cache=None):
 	"""
 	Returns SSL thumbprint for specified host
 
 	:param hostname: FQDN or IP of the host
 	:param port: port number of the host. Default is 443
 	:param algorithm: Hashing algorithm. Default is sha256
+	:param refresh: reconnect even if the certificate is cached
+	:param cache: CertCache to use. Default is the in-memory CERT_CACHE
 	"""
-	cert = get_pem_cert(address, port)
-	der_cert_bin = ssl.PEM_cert_to_DER_cert(cert)
+	cache = cache or CERT_CACHE
+	der_cert_bin = cache.get_or_fetch(hostname, port, refresh=refresh)
+	cache.save()
+	return thumbprint_from_der(der_cert_bin, algorithm)
+
 
-    if encryption == Encryption.SHA1:
-        thumbprint = hashlib.sha1(der_cert_bin).hexdigest()
-    elif encryption == Encryption.SHA256:
-        thumbprint = hashlib.sha256(der_cert_bin).hexdigest()
-    elif encryption == Encryption.MD5:
-        thumbprint = hashlib.md5(der_cert_bin).hexdigest()
-    else:
-        return der_cert_bin
-    return thumbprint
+def thumbprint_from_der(der_cert_bin, algorithm: Encryption = Encryption.SHA256):
+	"""
+	Returns SSL thumbprint of a DER encoded certificate, or the DER bytes for an unknown algorithm
+
+	:param der_cert_bin: certificate in DER format
+	:param algorithm: Hashing algorithm. Default is sha256
+	"""
+	if algorithm == Encryption.SHA1:
+		thumbprint = hashlib.sha1(der_cert_bin).hexdigest()
+	elif algorithm == Encryption.SHA256:
+		thumbprint = hashlib.sha256(der_cert_bin).hexdigest()
+	elif algorithm == Encryption.MD5:
+		thumbprint = hashlib.md5(der_cert_bin).hexdigest()
+	else:
+		return der_cert_bin
+	return thumbprint
+
+
+def get_der_cert(hostname, port=443, timeout=DEFAULT_TIMEOUT):
+	"""
+	Returns certificate for specified host in DER format, fetched in-process without verifying it
+
+	:param hostname: FQDN or IP of the host
+	:param port: port number of the host. Default is 443
+	:param timeout: connect and handshake timeout in seconds. Default is 5
+	"""
+	context = ssl.create_default_context()
+	context.check_hostname = False
+	context.verify_mode = ssl.CERT_NONE
+	try:
+		with METRICS.timer("tls_handshake_seconds"):
+			with socket.create_connection((hostname, port), timeout=timeout) as sock:
+				with context.wrap_socket(sock, server_hostname=hostname) as tls_sock:
+					return tls_sock.getpeercert(binary_form=True)
+	except Exception as ex:
+		METRICS.inc("tls_handshake_errors_total")
+		raise Exception(f"Failed to connect to address: {hostname}:{port}. Exception: {ex}")
+
+
+def parse_target(target, default_port=443):
+	"""
+	Returns tuple of (host, port) for "host", "host:port" or "[ipv6]:port"
+
+	:param target: host with optional port
+	:param default_port: port used when target has none. Default is 443
+	"""
+	if target.startswith("["):
+		host, _, port = target[1:].partition("]")
+		return host, int(port.lstrip(":") or default_port)
+	if target.count(":") == 1:
+		host, port = target.split(":")
+		return host, int(port)
+	return target, default_port
+
+
+def get_thumbprints(targets, algorithms=(Encryption.SHA256,), timeout=DEFAULT_TIMEOUT, max_workers=MAX_WORKERS,
+					refresh=False, cache=None):
+	"""
+	Returns dictionary of "host:port" -> {algorithm: thumbprint} for many hosts, fetching
+	certificates concurrently. Hosts that fail map to {"error": message} instead.
+
+	:param targets: list of "host", "host:port" or "[ipv6]:port" strings
+	:param algorithms: Hashing algorithms. Default is sha256
+	:param timeout: per connection timeout in seconds. Default is 5
+	:param max_workers: number of concurrent connections. Default is 64
+	:param refresh: reconnect even for cached certificates
+	:param cache: CertCache to use. Default is the in-memory CERT_CACHE
+	"""
+	cache = cache or CERT_CACHE
+
+	def fetch(target):
+		try:
+			der_cert_bin = cache.get_or_fetch(*parse_target(target), timeout=timeout, refresh=refresh)
+		except Exception as ex:
+			return {"error": str(ex)}
+		return {Encryption(algorithm).value: thumbprint_from_der(der_cert_bin, Encryption(algorithm))
+				for algorithm in algorithms}
+
+	if not targets:
+		return {}
+	with ThreadPoolExecutor(max_workers=min(max_workers, len(targets))) as pool:
+		results = dict(zip(targets, pool.map(fetch, targets)))
+	cache.save()
+	return results
 
 
 def format_thumbprint(thumbprint):
@@ -73,3 +246,33 @@ def format_thumbprint(thumbprint):
 	"""
 	thumbprint_string = thumbprint.split("=")[1]
 	return re.sub(":", "", thumbprint_string).lower()
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser("Thumbprint util")
+	parser.add_argument('targets', nargs='*', help="Hosts as host, host:port or [ipv6]:port")
+	parser.add_argument('-f', '--file', help="File with one target per line")
+	parser.add_argument('-a', '--algorithms', nargs='+', choices=[e.value for e in Encryption],
+						default=[Encryption.SHA256.value], help="Hashing algorithms. Default is sha256")
+	parser.add_argument('-t', '--timeout', type=float, default=DEFAULT_TIMEOUT,
+						help="Per connection timeout in seconds. Default is %s" % DEFAULT_TIMEOUT)
+	parser.add_argument('-w', '--workers', type=int, default=MAX_WORKERS,
+						help="Number of concurrent connections. Default is %s" % MAX_WORKERS)
+	parser.add_argument('-c', '--cache-file', help="JSON file caching certificates between runs")
+	parser.add_argument('--cache-ttl', type=int, default=CERT_CACHE_TTL,
+						help="Seconds a cached certificate is reused. Default is %s" % CERT_CACHE_TTL)
+	parser.add_argument('-r', '--refresh', action='store_true', default=False,
+						help="Reconnect to every host even if its certificate is cached")
+	args = parser.parse_args()
+
+	targets = list(args.targets)
+	if args.file:
+		with open(args.file) as fin:
+			targets.extend(line.strip() for line in fin if line.strip() and not line.startswith("#"))
+	if not targets:
+		parser.error("Specify targets or --file")
+	cache = CertCache(args.cache_ttl, args.cache_file)
+	results = get_thumbprints(targets, args.algorithms, args.timeout, args.workers, args.refresh, cache)
+	print(json.dumps(results, indent=2))
+	if any("error" in result for result in results.values()):
+		raise SystemExit(1)